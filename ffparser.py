@@ -1,8 +1,69 @@
 #! /usr/bin/env python
 
+import sys
+import json
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+from pythonscripts.cpu import usable_cpus
 from pythonscripts.ffparser import FFprobeParser
+from pythonscripts.probecache import ProbeCache, default_cache_path
+
+
+def requested_fields(args):
+    """ Returns the fields passed to FFprobeParser, so that ffprobe outputs only what is printed.
+    """
+    if args.pprint:
+        return [args.option]
+    return ["{}.{}".format(args.option, attribute) for attribute in args.attribute]
+
+
+def probe_record(path, args, cache):
+    """ Returns dict with the requested attributes of the file, which is printed as one NDJSON line.
+    """
+    record = {"path": path}
+    try:
+        ffparser = FFprobeParser(path, cache=cache, fields=requested_fields(args))
+    except Exception as e:
+        record["error"] = str(e)
+        return record
+    if args.pprint:
+        record[args.option] = getattr(ffparser, args.option)
+    else:
+        for attribute in args.attribute:
+            record[attribute] = ffparser.get(args.option, attribute)
+    return record
+
+
+def probe_many(paths, args, cache):
+    """ Probe files concurrently with at most 2*jobs files in flight, yielding
+        the records in input order or in completion order.
+    """
+    paths = iter(paths)
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        running = deque()
+        while True:
+            for path in paths:
+                running.append(executor.submit(probe_record, path, args, cache))
+                if len(running) >= 2 * args.jobs:
+                    break
+            if not running:
+                break
+            if args.order == "input":
+                yield running.popleft().result()
+            else:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.remove(future)
+                    yield future.result()
+
+
+def stdin_paths():
+    for line in sys.stdin:
+        line = line.rstrip("\n")
+        if line:
+            yield line
 
 
 if __name__ == "__main__":
@@ -14,14 +75,30 @@ if __name__ == "__main__":
     option.add_argument("-f", "--format", action="store_const", const="format", dest="option", help="get format attribute")
 
     action = parser.add_mutually_exclusive_group(required=True)
-    action.add_argument("-g", "--get", action="store", nargs=1, dest="attribute", help="attribute name to get")
+    action.add_argument("-g", "--get", action="append", dest="attribute", help="attribute name to get, can be given multiple times")
     action.add_argument("-p", "--print", action="store_true", dest="pprint", help="print all attributes and exit")
 
-    parser.add_argument("path", action="store", nargs=1, help="path to file to parse")
+    parser.add_argument("--cache", action="store_true", help="cache ffprobe results in an SQLite database")
+    parser.add_argument("--cache-file", action="store", default=default_cache_path(), metavar="PATH", help="path of the --cache database, default=%(default)s")
+    parser.add_argument("--ndjson", action="store_true", help="print one JSON record per file (default when multiple paths are given)")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=usable_cpus(), metavar="N", help="number of files probed concurrently, default=%(default)s")
+    parser.add_argument("--order", choices=("input", "completion"), default="input", help="order of the NDJSON records, default=input")
+    parser.add_argument("path", action="store", nargs="*", help="path(s) to file(s) to parse; paths are read from stdin (one per line) when none or '-' is given")
 
     args = parser.parse_args()
-    ffparser = FFprobeParser(args.path[0])
-    if args.pprint:
-        ffparser.pprint(args.option)
-    else:
-        print(ffparser.get(args.option, args.attribute[0]))
+    cache = ProbeCache(args.cache_file) if args.cache else None
+    try:
+        if len(args.path) == 1 and args.path[0] != "-" and not args.ndjson:
+            ffparser = FFprobeParser(args.path[0], cache=cache, fields=requested_fields(args))
+            if args.pprint:
+                ffparser.pprint(args.option)
+            else:
+                for attribute in args.attribute:
+                    print(ffparser.get(args.option, attribute))
+        else:
+            paths = stdin_paths() if args.path in ([], ["-"]) else args.path
+            for record in probe_many(paths, args, cache):
+                print(json.dumps(record), flush=args.order == "completion")
+    finally:
+        if cache is not None:
+            cache.close()
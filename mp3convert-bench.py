@@ -0,0 +1,180 @@
+#! /usr/bin/env python3
+
+"""
+Benchmark of the mp3convert.py pipeline on a synthetic corpus.
+
+The corpus is generated locally with ffmpeg's lavfi sources, so the benchmark
+runs offline. mp3convert.py is run in the dry-run mode and in the real mode
+(into a separate output directory, so the corpus stays unchanged and the
+benchmark can be repeated) with --profile-trace, and the throughput of each
+stage is appended to a JSON results file.
+"""
+
+import sys
+import os
+import argparse
+import json
+import random
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from pythonscripts.benchresults import save_results
+from pythonscripts.cpu import usable_cpus
+from pythonscripts.profiler import percentile
+
+
+# codec name -> (file extension, ffmpeg encoder options)
+CODECS = {
+    "flac": ("flac", ["-c:a", "flac"]),
+    "ogg": ("ogg", ["-c:a", "libvorbis"]),
+    "m4a": ("m4a", ["-c:a", "aac"]),
+    "wav": ("wav", ["-c:a", "pcm_s16le"]),
+    "mp3": ("mp3", ["-c:a", "libmp3lame"]),
+}
+LOSSLESS = ("flac", "wav")
+
+mp3convert = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mp3convert.py")
+
+
+def comma_list(type):
+    def parse(value):
+        try:
+            return [type(x) for x in value.split(",")]
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid list: '%s'" % value)
+    return parse
+
+
+def corpus_spec(args):
+    """ Returns list of tuples (relative path, codec, duration, bitrate, frequency).
+        The list depends only on the arguments, so the corpus is reproducible.
+    """
+    rng = random.Random(args.seed)
+    spec = []
+    for i in range(args.files):
+        codec = args.codecs[i % len(args.codecs)]
+        duration = rng.choice(args.durations)
+        bitrate = rng.choice(args.bitrates)
+        frequency = rng.randint(100, 2000)
+        dirs = ["d%d" % rng.randrange(args.fanout) for _ in range(args.depth)]
+        name = "track%05d.%s" % (i, CODECS[codec][0])
+        spec.append((os.path.join(*dirs, name), codec, duration, bitrate, frequency))
+    return spec
+
+
+def generate_file(root, relpath, codec, duration, bitrate, frequency):
+    path = os.path.join(root, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cmd = ["ffmpeg", "-v", "error", "-nostdin", "-y",
+           "-f", "lavfi", "-i", "sine=frequency=%d:sample_rate=44100:duration=%g" % (frequency, duration),
+           "-ac", "2"] + CODECS[codec][1]
+    if codec not in LOSSLESS:
+        cmd += ["-b:a", "%dk" % bitrate]
+    cmd += ["-metadata", "title=%s" % os.path.basename(relpath), path]
+    subprocess.run(cmd, check=True)
+
+
+def generate_corpus(root, spec, jobs):
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in [executor.submit(generate_file, root, *item) for item in spec]:
+            future.result()
+
+
+def summarize_trace(path, wall):
+    stages = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            stage = stages.setdefault(record["stage"], {"seconds": [], "bytes": 0})
+            stage["seconds"].append(record["seconds"])
+            stage["bytes"] += record["bytes"]
+    summary = {}
+    for name, stage in stages.items():
+        seconds = sorted(stage["seconds"])
+        summary[name] = {
+            "files": len(seconds),
+            "busy_seconds": sum(seconds),
+            "files_per_second": len(seconds) / wall,
+            "mb_per_second": stage["bytes"] / wall / 1e6,
+            "p50_ms": 1000 * percentile(seconds, 50),
+            "p95_ms": 1000 * percentile(seconds, 95),
+            "p99_ms": 1000 * percentile(seconds, 99),
+        }
+    return summary
+
+
+def run_mp3convert(name, corpus, workdir, extra_args):
+    trace = os.path.join(workdir, "trace-%s.ndjson" % name)
+    cmd = [sys.executable, mp3convert, "-r", "--profile-trace", trace] + extra_args + [corpus]
+    print("Running: {}".format(" ".join(cmd)))
+    start = time.monotonic()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    wall = time.monotonic() - start
+    return {"wall_seconds": wall, "stages": summarize_trace(trace, wall)}
+
+
+def print_result(result):
+    for run, data in result["runs"].items():
+        print("{}: {:.2f} s".format(run, data["wall_seconds"]))
+        for stage, s in data["stages"].items():
+            print("    %-8s %6d files, %8.1f files/s, %8.2f MB/s, p50 %.1f ms, p95 %.1f ms" %
+                  (stage, s["files"], s["files_per_second"], s["mb_per_second"], s["p50_ms"], s["p95_ms"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark mp3convert.py on a synthetic corpus generated with ffmpeg")
+    parser.add_argument("-n", "--files", action="store", type=int, default=200, help="number of files in the corpus, default=200")
+    parser.add_argument("--durations", action="store", type=comma_list(float), default=[5, 30, 180], metavar="SECONDS,...", help="durations of the files, default=5,30,180")
+    parser.add_argument("--codecs", action="store", type=comma_list(str), default=list(CODECS), metavar="CODEC,...", help="codecs of the files (%s), default=all" % ",".join(CODECS))
+    parser.add_argument("--bitrates", action="store", type=comma_list(int), default=[128, 192, 320], metavar="KBPS,...", help="bitrates of the lossy files, default=128,192,320")
+    parser.add_argument("--depth", action="store", type=int, default=2, help="nesting depth of the directory tree, default=2")
+    parser.add_argument("--fanout", action="store", type=int, default=4, help="number of subdirectories on each level, default=4")
+    parser.add_argument("--seed", action="store", type=int, default=0, help="seed of the corpus generator, default=0")
+    parser.add_argument("--workdir", action="store", help="directory for the corpus and outputs; an existing corpus is reused, default is a temporary directory")
+    parser.add_argument("--no-real", action="store_true", help="run only the dry-run benchmark")
+    parser.add_argument("-o", "--results", action="store", default="mp3convert-bench.json", help="JSON file to which the results are appended, default=%(default)s")
+    parser.add_argument("mp3convert_args", nargs=argparse.REMAINDER, help="additional arguments for mp3convert.py (after --)")
+
+    args = parser.parse_args()
+    for codec in args.codecs:
+        if codec not in CODECS:
+            parser.error("unknown codec: '%s'" % codec)
+    extra_args = [a for a in args.mp3convert_args if a != "--"]
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mp3convert-bench.")
+    corpus = os.path.join(workdir, "corpus")
+    output = os.path.join(workdir, "output")
+    spec = corpus_spec(args)
+
+    if not os.path.isdir(corpus):
+        print("Generating {} files in {}".format(len(spec), corpus))
+        start = time.monotonic()
+        generate_corpus(corpus, spec, usable_cpus())
+        print("Generated in {:.1f} s".format(time.monotonic() - start))
+
+    result = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "cpus": usable_cpus(),
+        "corpus": {"files": args.files, "durations": args.durations, "codecs": args.codecs,
+                   "bitrates": args.bitrates, "depth": args.depth, "fanout": args.fanout, "seed": args.seed,
+                   "bytes": sum(os.path.getsize(os.path.join(corpus, item[0])) for item in spec)},
+        "mp3convert_args": extra_args,
+        "runs": {},
+    }
+    result["runs"]["dry-run"] = run_mp3convert("dry-run", corpus, workdir, ["--dry-run"] + extra_args)
+    if not args.no_real:
+        shutil.rmtree(output, ignore_errors=True)
+        result["runs"]["real"] = run_mp3convert("real", corpus, workdir, ["--output-dir", output] + extra_args)
+
+    print_result(result)
+    save_results(args.results, result)
+    print("Results appended to {}".format(args.results))
+    if not args.workdir:
+        shutil.rmtree(workdir)
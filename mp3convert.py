@@ -6,18 +6,34 @@ import argparse
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import re
-import shutil
 import subprocess
 import shlex
+import shutil
+import time
+import threading
+import itertools
 
-from pythonscripts.cpu import cores_count
+from pythonscripts.cpu import usable_cpus, split_budget
+from pythonscripts.misc import format_sizeof
 from pythonscripts.tempfiles import TempFiles
-from pythonscripts.ffparser import FFprobeParser
+from pythonscripts.ffparser import get_audio_bitrate
+from pythonscripts.probecache import ProbeCache, default_cache_path
+from pythonscripts.journal import Journal, stat_key
+from pythonscripts.profiler import Profiler
+from pythonscripts.dedup import ContentIndex, clone_file
+from pythonscripts.pressure import AdaptiveLimit
+from pythonscripts.walk import scandir_walk
+from pythonscripts.scheduling import lpt_order
+from pythonscripts.prefetch import Prefetcher
 
 
 audio_types = ("mp3", "aac", "ac3", "mp2", "wma", "wav", "mka", "m4a", "ogg", "oga", "flac")
 audio_file_regex = re.compile("^(?P<dirname>/(.*/)*)(?P<filename>.*(?P<extension>\.(" + "|".join(audio_types) + ")))$")
-ffmpeg_command = "ffmpeg -i {input} -acodec libmp3lame -ar 44100 -ab {bitrate:d}k -ac 2 -f mp3 -map_metadata 0 -y {output}"
+ffmpeg_command = "ffmpeg -threads {threads:d} -i {input} -acodec libmp3lame -ar 44100 -ab {bitrate:d}k -ac 2 -f mp3 -map_metadata 0 -threads {threads:d} -y {output}"
+# batch mode: one ffmpeg process with multiple inputs, each mapped to its own output
+ffmpeg_batch_command = "ffmpeg -threads {threads:d} {inputs} {outputs}"
+ffmpeg_batch_input = "-i {input}"
+ffmpeg_batch_output = "-map {index:d}:a:0 -map {index:d}:v:0? -acodec libmp3lame -ar 44100 -ab {bitrate:d}k -ac 2 -f mp3 -map_metadata {index:d} -threads {threads:d} -y {output}"
 
 
 class GettingBitrateError(Exception):
@@ -27,31 +43,127 @@ class GettingBitrateError(Exception):
 
 class ConversionError(Exception):
     def __init__(self, fname, status, output):
+        if isinstance(output, bytes):
+            output = output.decode(errors="replace")
         self.message = "Error while converting file " + fname + "\nffmpeg exited with status " + str(status) + "\n" + output
 
 
-def get_bitrate(filename):
-    parser = FFprobeParser(filename)
-    bitrate = parser.get("audio", "bit_rate")
-    del parser
+def get_bitrate(filename, cache=None):
+    """ Returns tuple (bitrate in kb/s, source of the value).
+    """
+    bitrate, source = get_audio_bitrate(filename, cache)
     if bitrate is None:
         raise GettingBitrateError(filename)
     else:
-        return bitrate // 1000
-
-
-def convert(filename, output_extension, bitrate, delete_after=False):
-    tmpfile = tmp.getTempFileName()
-    command = ffmpeg_command.format(input=shlex.quote(filename), bitrate=bitrate, output=shlex.quote(tmpfile))
+        return bitrate // 1000, source
+
+
+def convert(filename, output, bitrate, delete_after=False, journal=None, threads=1, profiler=None, size=0):
+    """ 'profiler' is an optional Profiler object, 'size' is the size of the input file.
+    """
+    profiler = profiler or Profiler()
+    # the temporary file is created next to the output, so the commit is a rename
+    tmpfile = tmp.getTempFileNameFor(output)
+    if journal is not None:
+        journal.record(filename, "started", tmp=tmpfile)
+    command = ffmpeg_command.format(input=shlex.quote(filename), bitrate=bitrate, output=shlex.quote(tmpfile), threads=threads)
     try:
-        subprocess.run(command, shell=True, check=True, capture_output=True)
-        if delete_after:
-            os.remove(filename)
-        shutil.move(tmpfile, os.path.splitext(filename)[0] + output_extension)
+        with profiler.stage("encode", filename, size):
+            subprocess.run(command, shell=True, check=True, capture_output=True)
+        with profiler.stage("move", filename, os.path.getsize(tmpfile) if profiler.enabled else 0):
+            tmp.commit(tmpfile, output)
+        if delete_after and filename != output:
+            with profiler.stage("delete", filename):
+                os.remove(filename)
+    except subprocess.CalledProcessError as e:
         tmp.remove(tmpfile)
+        raise ConversionError(filename, e.returncode, e.stderr)
+
+
+def convert_batch(jobs, bitrate, delete_after=False, journal=None, threads=1, profiler=None):
+    """ Convert multiple files with one ffmpeg process. 'jobs' is a list of tuples
+        (filename, output, size). If any of the inputs fails, no output is committed.
+    """
+    profiler = profiler or Profiler()
+    tmpfiles = [tmp.getTempFileNameFor(output) for _, output, _ in jobs]
+    if journal is not None:
+        for (filename, _, _), tmpfile in zip(jobs, tmpfiles):
+            journal.record(filename, "started", tmp=tmpfile)
+    inputs = " ".join(ffmpeg_batch_input.format(input=shlex.quote(filename)) for filename, _, _ in jobs)
+    outputs = " ".join(ffmpeg_batch_output.format(index=i, bitrate=bitrate, threads=threads, output=shlex.quote(tmpfile))
+                       for i, tmpfile in enumerate(tmpfiles))
+    command = ffmpeg_batch_command.format(threads=threads, inputs=inputs, outputs=outputs)
+    try:
+        start = time.monotonic()
+        subprocess.run(command, shell=True, check=True, capture_output=True)
+        # the time of the batch is split between the files proportionally to their size
+        elapsed = time.monotonic() - start
+        total_size = sum(size for _, _, size in jobs) or 1
+        for filename, _, size in jobs:
+            profiler.record("encode", elapsed * size / total_size, filename, size)
     except subprocess.CalledProcessError as e:
+        for tmpfile in tmpfiles:
+            tmp.remove(tmpfile)
+        raise ConversionError(", ".join(filename for filename, _, _ in jobs), e.returncode, e.stderr)
+    for (filename, output, _), tmpfile in zip(jobs, tmpfiles):
+        with profiler.stage("move", filename, os.path.getsize(tmpfile) if profiler.enabled else 0):
+            tmp.commit(tmpfile, output)
+        if delete_after and filename != output:
+            with profiler.stage("delete", filename):
+                os.remove(filename)
+
+
+def copy(filename, output):
+    """ Copy file to 'output' through a temporary file, preserving its mtime.
+    """
+    tmpfile = tmp.getTempFileNameFor(output)
+    try:
+        shutil.copy2(filename, tmpfile)
+        tmp.commit(tmpfile, output)
+    except OSError:
         tmp.remove(tmpfile)
-        raise ConversionError(filename, e.returncode, e.output)
+        raise
+
+
+class Job:
+    """ State of a file passed from the probe stage to the encode stage.
+    """
+
+    def __init__(self, path, relpath):
+        self.path = path
+        self.relpath = relpath
+        self.st = None
+        self.output = None
+        # deduplication: "pending" until encoded, then "done" or "failed";
+        # followers are jobs with the same content waiting for this one
+        self.state = "pending"
+        self.followers = []
+        self.encodeSeconds = 0.0
+
+
+class StageQueue(asyncio.Queue):
+    """ Bounded queue between pipeline stages, which keeps track of its depth.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize=maxsize)
+        self.samples = 0
+        self.depthSum = 0
+        self.depthMax = 0
+
+    def _sample(self):
+        depth = self.qsize()
+        self.samples += 1
+        self.depthSum += depth
+        self.depthMax = max(self.depthMax, depth)
+
+    async def put(self, item):
+        await super().put(item)
+        self._sample()
+
+    def depth_stats(self):
+        mean = self.depthSum / self.samples if self.samples else 0
+        return "avg %.1f, max %d of %d" % (mean, self.depthMax, self.maxsize)
 
 
 class Main():
@@ -61,6 +173,17 @@ class Main():
         self.countDifferentFormat = 0
         self.countErrors = 0
         self.countNonAudioFiles = 0
+        self.countJournalSkipped = 0
+        self.countBitrateSources = {"header": 0, "cache": 0, "ffprobe": 0}
+        self.countUpToDate = 0
+        self.countCopied = 0
+        self.countPruned = 0
+        self.countDuplicates = 0
+        self.bytesDeduplicated = 0
+        self.secondsDeduplicated = 0.0
+        self.countCloneMethods = {"hardlink": 0, "reflink": 0, "copy": 0}
+        # the counters are updated from the probe and encode threads
+        self.statsLock = threading.Lock()
 
         self.dry_run = args.dry_run
         self.bitrate = args.bitrate
@@ -69,6 +192,47 @@ class Main():
         self.deleteAfter = args.delete_after
         self.outputExtension = "." + args.output_extension
         self.paths = args.path
+        self.outputDir = os.path.abspath(args.output_dir) if args.output_dir else None
+        self.prune = args.prune
+        # output paths of all source files, needed only to find orphans when pruning
+        self.outputs = set()
+        # preferred method of creating the outputs of duplicates, None if disabled
+        self.dedup = args.dedup_method if args.dedup else None
+        self.contentIndex = ContentIndex() if args.dedup else None
+        self.dedupLock = threading.Lock()
+        self.probeJobs = args.probe_jobs or 4 * usable_cpus()
+        # each ffmpeg process gets an equal share of the CPU budget
+        self.encodeJobs, self.encodeThreads = split_budget(workers=args.encode_jobs)
+        # the number of running encoders is limited by self.encodeLimit, which is
+        # adjusted between --min-jobs and --max-jobs in the adaptive mode
+        self.adaptive = args.adaptive
+        if self.adaptive:
+            self.maxEncodeJobs = args.max_jobs or 2 * usable_cpus()
+            self.encodeLimit = AdaptiveLimit(args.min_jobs, self.maxEncodeJobs, initial=self.encodeJobs)
+        else:
+            self.maxEncodeJobs = self.encodeJobs
+            self.encodeLimit = AdaptiveLimit(self.encodeJobs, self.encodeJobs)
+        self.probeQueue = None
+        self.encodeQueue = None
+        # batching of small files
+        self.batchSmall = args.batch_small * 1024
+        self.batchFiles = args.batch_files
+        self.batch = []
+        self.batchBytes = 0
+        self.countBatches = 0
+        self.countBatchFailures = 0
+        self.profiler = Profiler(args.profile, args.profile_trace)
+        self.prefetcher = None
+        if args.prefetch:
+            self.prefetcher = Prefetcher(args.prefetch, args.prefetch_budget * 1024 * 1024, args.prefetch_mode)
+        self.schedule = args.schedule
+        self.lookahead = args.lookahead
+        self.probeCache = ProbeCache(args.probe_cache_file) if args.probe_cache else None
+        self.journal = None
+        if args.journal:
+            self.journal = Journal(args.journal)
+            if not self.dry_run:
+                self.cleanup_journal()
 
     def print_stats(self):
         print()
@@ -77,100 +241,401 @@ class Main():
         print("Converted files:                    % 6d" % (self.countDifferentFormat + self.countHigherBitrate))
         print("    - different format:             % 6d" % self.countDifferentFormat)
         print("    - %3s but higher bitrate:       % 6d" % (self.outputExtension[1:], self.countHigherBitrate))
+        if self.outputDir is not None:
+            print("Copied (bitrate already ok):        % 6d" % self.countCopied)
+            print("Up to date in output directory:     % 6d" % self.countUpToDate)
+            if self.prune:
+                print("Pruned from output directory:       % 6d" % self.countPruned)
         print("Errors:                             % 6d" % self.countErrors)
+        if self.journal is not None:
+            print("Skipped (done according to journal):% 6d" % self.countJournalSkipped)
         print("Non-audio files:                    % 6d" % self.countNonAudioFiles)
+        if self.dedup:
+            print("Duplicates (encoded only once):     % 6d" % self.countDuplicates)
+            print("    - input bytes not encoded:      % 6s" % format_sizeof(self.bytesDeduplicated, "short"))
+            print("    - encode seconds saved:         % 6.0f" % self.secondsDeduplicated)
+            print("    - hardlinks/reflinks/copies:    % 6d/%d/%d" % (self.countCloneMethods["hardlink"], self.countCloneMethods["reflink"], self.countCloneMethods["copy"]))
+        print("Bitrate from header/cache/ffprobe:  % 6d/%d/%d" % (self.countBitrateSources["header"], self.countBitrateSources["cache"], self.countBitrateSources["ffprobe"]))
+        if self.probeCache is not None:
+            print("Probe cache hits/misses:            % 6d/%d" % (self.probeCache.hits, self.probeCache.misses))
+        if self.batchSmall:
+            print("Batches (failed and retried):       % 6d (%d)" % (self.countBatches, self.countBatchFailures))
+        if self.probeQueue is not None:
+            print("Probe queue depth (%3d jobs):       %s" % (self.probeJobs, self.probeQueue.depth_stats()))
+            print("Encode queue depth (%3d jobs):      %s" % (self.maxEncodeJobs, self.encodeQueue.depth_stats()))
+        if self.prefetcher is not None:
+            p = self.prefetcher
+            print("Prefetched files (%6s):        % 6d" % (format_sizeof(p.bytesPrefetched, "short"), p.countPrefetched))
+            print("    - hits/late/misses:             % 6d/%d/%d" % (p.countHits, p.countLate, p.countMisses))
+        if self.adaptive:
+            print("Concurrency changes (final jobs):   % 6d (%d)" % (self.encodeLimit.changes, self.encodeLimit.limit))
         print("------------------------------------------")
 
     def check(self, path):
         match = re.match(audio_file_regex, path)
 
         if not match:
-            self.countNonAudioFiles += 1
+            with self.statsLock:
+                self.countNonAudioFiles += 1
             return False
 
         filename = match.group("filename")
         ext = match.group("extension")
 
-        self.countAudioFiles += 1
-        if ext != self.outputExtension:
-            self.countDifferentFormat += 1
-            return True
+        with self.statsLock:
+            self.countAudioFiles += 1
+            if ext != self.outputExtension:
+                self.countDifferentFormat += 1
+                return True
 
-        bitrate = get_bitrate(path)
+        bitrate, source = get_bitrate(path, self.probeCache)
         if self.verbose > 0:
             sys.stdout.write("% 3s kb/s: %s\n" % (bitrate, filename))
-        if bitrate > self.bitrate:
-            self.countHigherBitrate += 1
-            return True
+        with self.statsLock:
+            self.countBitrateSources[source] += 1
+            if bitrate > self.bitrate:
+                self.countHigherBitrate += 1
+                return True
         return False
 
     async def run(self):
         # We could use the default single-threaded executor with basically the same performance
         # (because of Python's GIL), but the ThreadPoolExecutor allows to limit the maximum number
         # of workers and thus the maximum number of concurrent subprocesses.
-        with ThreadPoolExecutor(max_workers=cores_count()) as executor:
-            loop = asyncio.get_event_loop()
-            tasks = [
-                loop.run_in_executor(executor, self.worker, path)
-                for path in self.queue_generator()
-            ]
-            for result in await asyncio.gather(*tasks):
-                pass
-
+        #
+        # The work is split into two stages with separate pools: a wide probe stage (cheap,
+        # I/O bound checks of the input files) feeding a narrow encode stage sized to the CPU.
+        # The queues between the directory walk and the stages are bounded, so the walk is
+        # only a few items ahead of the conversions and memory usage does not depend on the
+        # number of files. The walk itself runs in a separate thread so that a slow scandir
+        # (e.g. on a network filesystem) does not block the event loop.
+        self.probeQueue = StageQueue(maxsize=2 * self.probeJobs)
+        self.encodeQueue = StageQueue(maxsize=2 * self.maxEncodeJobs)
+        with ThreadPoolExecutor(max_workers=self.probeJobs) as probe_executor, \
+             ThreadPoolExecutor(max_workers=self.maxEncodeJobs) as encode_executor, \
+             ThreadPoolExecutor(max_workers=1) as walk_executor:
+            loop = asyncio.get_running_loop()
+
+            async def producer():
+                items = self.queue_generator()
+                if self.schedule == "lpt":
+                    items = lpt_order(items, self.job_cost, self.lookahead)
+                while True:
+                    start = time.monotonic()
+                    item = await loop.run_in_executor(walk_executor, next, items, None)
+                    if item is None:
+                        break
+                    self.profiler.record("walk", time.monotonic() - start, item[0])
+                    await self.probeQueue.put(item)
+                for _ in range(self.probeJobs):
+                    await self.probeQueue.put(None)
+
+            async def prober():
+                while True:
+                    item = await self.probeQueue.get()
+                    if item is None:
+                        break
+                    job = await loop.run_in_executor(probe_executor, self.probe_worker, *item)
+                    if job is None:
+                        continue
+                    if self.prefetcher is not None:
+                        self.prefetcher.enqueue(job.path, job.st.st_size)
+                    if self.batchSmall and job.st.st_size <= self.batchSmall:
+                        await self.add_to_batch(job)
+                    else:
+                        await self.encodeQueue.put(job)
+
+            async def probe_stage():
+                await asyncio.gather(*[prober() for _ in range(self.probeJobs)])
+                await self.flush_batch()
+                for _ in range(self.maxEncodeJobs):
+                    await self.encodeQueue.put(None)
+
+            async def encoder():
+                while True:
+                    item = await self.encodeQueue.get()
+                    if item is None:
+                        break
+                    jobs = item if isinstance(item, list) else [item]
+                    async with self.encodeLimit:
+                        if self.prefetcher is not None:
+                            for job in jobs:
+                                self.prefetcher.claim(job.path)
+                        if isinstance(item, list):
+                            await loop.run_in_executor(encode_executor, self.encode_batch, item)
+                        else:
+                            await loop.run_in_executor(encode_executor, self.encode_worker, item)
+                        self.encodeLimit.job_done(sum(job.st.st_size for job in jobs))
+                        if self.prefetcher is not None:
+                            for job in jobs:
+                                self.prefetcher.release(job.path)
+
+            controller = asyncio.create_task(self.encodeLimit.control()) if self.adaptive else None
+            await asyncio.gather(producer(), probe_stage(), *[encoder() for _ in range(self.maxEncodeJobs)])
+            if controller is not None:
+                controller.cancel()
+
+        if self.outputDir is not None and self.prune:
+            self.prune_output_dir()
+
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self.probeCache is not None:
+            self.probeCache.close()
+        if self.journal is not None:
+            self.journal.close()
         self.print_stats()
+        self.profiler.report()
+        self.profiler.close()
 
-    def worker(self, path):
-        path = os.path.abspath(path)
+    async def add_to_batch(self, job):
+        """ Collect small files into batches converted by a single ffmpeg process. A batch
+            is closed when it has --batch-files files or half of the maximum total size,
+            so there are fewer files in a batch when the files are bigger.
+        """
+        self.batch.append(job)
+        self.batchBytes += job.st.st_size
+        if len(self.batch) >= self.batchFiles or self.batchBytes >= self.batchSmall * self.batchFiles // 2:
+            await self.flush_batch()
+
+    async def flush_batch(self):
+        batch = self.batch
+        self.batch = []
+        self.batchBytes = 0
+        if len(batch) == 1:
+            await self.encodeQueue.put(batch[0])
+        elif batch:
+            await self.encodeQueue.put(batch)
+
+    def cleanup_journal(self):
+        """ Remove temporary files left behind by conversions interrupted in the previous run.
+        """
+        for record in self.journal.unfinished():
+            tmpfile = record.get("tmp")
+            if tmpfile and os.path.exists(tmpfile):
+                if self.verbose > 0:
+                    print("Removing stale temporary file: {}".format(tmpfile))
+                os.remove(tmpfile)
+
+    def error(self, job, msg, exc):
+        if self.verbose > 0:
+            msg += "\n" + exc.message
+        print(msg, file=sys.stderr)
+        with self.statsLock:
+            self.countErrors += 1
+        if self.journal is not None and not self.dry_run:
+            self.journal.record(job.path, "failed", job.st)
 
+    def job_cost(self, item):
+        """ Estimated cost of converting the file, which is its size.
+        """
         try:
-            # check bitrate/filetype etc., skip if conversion not necessary
-            if not self.check(path) or self.dry_run:
-                return
-            print("Converting: {}".format(path))
-            convert(path, self.outputExtension, self.bitrate, self.deleteAfter)
-        except ConversionError as e:
-            msg = "ERROR: failed to convert file '{}'".format(path)
-            if self.verbose > 0:
-                msg += "\n" + e.message
-            print(msg, file=sys.stderr)
-            self.countErrors += 1
-        except GettingBitrateError as e:
-            msg = "ERROR: failed to get bitrate from file '{}'".format(path)
-            if self.verbose > 0:
-                msg += "\n" + e.message
-            print(msg, file=sys.stderr)
-            self.countErrors += 1
-        else:
-            print("Done: {}".format(path))
+            return os.path.getsize(item[0])
+        except OSError:
+            return 0
+
+    def output_path(self, job):
+        if self.outputDir is None:
+            # in-place conversion
+            return os.path.splitext(job.path)[0] + self.outputExtension
+        return os.path.join(self.outputDir, os.path.splitext(job.relpath)[0] + self.outputExtension)
+
+    def is_up_to_date(self, job):
+        """ In the mirror mode, returns True if the output exists and is not older than the source.
+        """
+        if self.outputDir is None:
+            return False
+        try:
+            return os.stat(job.output).st_mtime_ns >= job.st.st_mtime_ns
+        except FileNotFoundError:
+            return False
 
-    def queue_generator(self):
-        """ For each directory in self.files returns generator returning full paths to mp3 files in that folder.
-            If self.files contains file paths instead of directory, it's returned as [file].
+    def journal_done(self, job):
+        """ Returns True if the file was already processed according to the journal.
+            In the mirror mode the output must exist too, otherwise it is made again.
+        """
+        if not self.journal.is_done(job.path, job.st):
+            return False
+        return self.outputDir is None or job.output is None or os.path.exists(job.output)
+
+    def probe_worker(self, path, relpath):
+        """ Returns a Job if the file needs to be converted, otherwise None.
         """
+        job = Job(os.path.abspath(path), relpath)
 
-        def walk(root):
-            dirs = []
-            files = []
-            for entry in os.scandir(root):
-                if entry.is_dir():
-                    dirs.append(entry.name)
-                elif entry.is_file():
-                    files.append(entry.name)
+        try:
+            job.st = os.stat(job.path)
+            with self.profiler.stage("probe", job.path, job.st.st_size):
+                if re.match(audio_file_regex, job.path):
+                    job.output = self.output_path(job)
+                    if self.outputDir is not None and self.prune:
+                        self.outputs.add(job.output)
+                    if self.is_up_to_date(job):
+                        with self.statsLock:
+                            self.countUpToDate += 1
+                        return None
+                if self.journal is not None and self.journal_done(job):
+                    with self.statsLock:
+                        self.countJournalSkipped += 1
+                    return None
+                # check bitrate/filetype etc., skip if conversion not necessary
+                if not self.check(job.path):
+                    if job.output is not None and self.outputDir is not None:
+                        # mirror the file as is
+                        if not self.dry_run:
+                            os.makedirs(os.path.dirname(job.output), exist_ok=True)
+                            copy(job.path, job.output)
+                        with self.statsLock:
+                            self.countCopied += 1
+                    if self.journal is not None and not self.dry_run:
+                        self.journal.record(job.path, "skipped", job.st, output=job.output)
+                    return None
+        except GettingBitrateError as e:
+            self.error(job, "ERROR: failed to get bitrate from file '{}'".format(job.path), e)
+            return None
+        if self.contentIndex is not None and not self.deduplicate(job):
+            return None
+        if self.dry_run:
+            return None
+        return job
+
+    def deduplicate(self, job):
+        """ Returns True if the job has to be encoded, False if it is a duplicate
+            of another job and its output will be cloned from that job's output.
+        """
+        primary = self.contentIndex.claim(job.path, job.st.st_size, job)
+        if primary is job:
+            return True
+        with self.dedupLock:
+            if primary.state == "failed":
+                # try to encode it on its own
+                return True
+            self.countDuplicates += 1
+            self.bytesDeduplicated += job.st.st_size
+            if primary.state == "pending":
+                primary.followers.append(job)
+                return False
+        if not self.dry_run:
+            self.clone_output(primary, job)
+        return False
 
-            # first yield found files, then recurse into subdirs
+    def clone_output(self, primary, job):
+        try:
+            os.makedirs(os.path.dirname(job.output), exist_ok=True)
+            tmpfile = tmp.getTempFileNameFor(job.output)
+            method = clone_file(primary.output, tmpfile, self.dedup)
+            tmp.commit(tmpfile, job.output)
+            if self.deleteAfter and job.path != job.output:
+                os.remove(job.path)
+        except OSError as e:
+            print("ERROR: failed to create '{}' from '{}': {}".format(job.output, primary.output, e), file=sys.stderr)
+            with self.statsLock:
+                self.countErrors += 1
+            if self.journal is not None:
+                self.journal.record(job.path, "failed", job.st)
+            return
+        with self.dedupLock:
+            self.countCloneMethods[method] += 1
+            self.secondsDeduplicated += primary.encodeSeconds
+        print("Done (duplicate of {}): {}".format(primary.path, job.path))
+        if self.journal is not None:
+            self.journal.record(job.path, "converted", job.st, output=job.output, output_stat=stat_key(os.stat(job.output)))
+
+    def encode_worker(self, job):
+        try:
+            print("Converting: {}".format(job.path))
+            os.makedirs(os.path.dirname(job.output), exist_ok=True)
+            start = time.monotonic()
+            convert(job.path, job.output, self.bitrate, self.deleteAfter, self.journal,
+                    self.encodeThreads, self.profiler, job.st.st_size)
+            job.encodeSeconds = time.monotonic() - start
+        except ConversionError as e:
+            self.error(job, "ERROR: failed to convert file '{}'".format(job.path), e)
+            state = "failed"
+        else:
+            print("Done: {}".format(job.path))
+            if self.journal is not None:
+                self.journal.record(job.path, "converted", job.st, output=job.output, output_stat=stat_key(os.stat(job.output)))
+            state = "done"
+        self.finish(job, state)
+
+    def encode_batch(self, jobs):
+        print("Converting batch of {} files:".format(len(jobs)))
+        for job in jobs:
+            print("  {}".format(job.path))
+            os.makedirs(os.path.dirname(job.output), exist_ok=True)
+        try:
+            start = time.monotonic()
+            convert_batch([(job.path, job.output, job.st.st_size) for job in jobs], self.bitrate, self.deleteAfter,
+                          self.journal, self.encodeThreads, self.profiler)
+            elapsed = time.monotonic() - start
+        except ConversionError as e:
+            # isolate the bad input by converting the files one by one
+            if self.verbose > 0:
+                print("Batch conversion failed, converting the files separately\n" + e.message, file=sys.stderr)
+            with self.statsLock:
+                self.countBatchFailures += 1
+            for job in jobs:
+                self.encode_worker(job)
+            return
+        with self.statsLock:
+            self.countBatches += 1
+        for job in jobs:
+            job.encodeSeconds = elapsed / len(jobs)
+            print("Done: {}".format(job.path))
+            if self.journal is not None:
+                self.journal.record(job.path, "converted", job.st, output=job.output, output_stat=stat_key(os.stat(job.output)))
+            self.finish(job, "done")
+
+    def finish(self, job, state):
+        """ Mark the job as finished and create outputs of its duplicates.
+        """
+        with self.dedupLock:
+            job.state = state
+            followers = job.followers
+            job.followers = []
+        for follower in followers:
+            if job.state == "done":
+                self.clone_output(job, follower)
+            else:
+                with self.dedupLock:
+                    self.countDuplicates -= 1
+                    self.bytesDeduplicated -= follower.st.st_size
+                self.encode_worker(follower)
+
+    def prune_output_dir(self):
+        """ Remove files from the output directory which do not correspond to any source file.
+            Each source directory is mirrored into the output directory itself, so
+            the walked part of it is the whole tree with --recursive and only its
+            top level otherwise. Subdirectories are not pruned in the latter case.
+        """
+        if self.recursive:
+            tree = os.walk(self.outputDir, topdown=False)
+        else:
+            tree = itertools.islice(os.walk(self.outputDir), 1)
+        for root, dirs, files in tree:
             for f in files:
-                yield os.path.join(root, f)
-            if self.recursive:
-                for d in dirs:  # recurse into subdir
-                    for f in walk(os.path.join(root, d)):
-                        yield f
+                path = os.path.join(root, f)
+                if path not in self.outputs:
+                    print("Pruning: {}".format(path))
+                    self.countPruned += 1
+                    if not self.dry_run:
+                        os.remove(path)
+            if root != self.outputDir and not self.dry_run and not os.listdir(root):
+                os.rmdir(root)
 
+    def queue_generator(self):
+        """ For each directory in self.files returns generator returning tuples (path, relpath),
+            where 'path' is the full path to a file in that folder and 'relpath' is the path
+            relative to the folder. If self.files contains file paths instead of directory,
+            (file, basename) is returned.
+        """
         for path in self.paths:
             if os.path.isdir(path):
-                for f in walk(path):
-                    yield f
+                for entry in scandir_walk([path], recursive=self.recursive, follow_symlinks=True):
+                    yield entry.path, os.path.relpath(entry.path, path)
             else:
-                yield path
+                yield path, os.path.basename(path)
 
 
 if __name__ == "__main__":
@@ -182,8 +647,39 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbose", action="count", default=0, help="set verbosity level")
     parser.add_argument("--delete-after", action="store_true", help="delete old files after conversion")
     parser.add_argument("--output-extension", choices=audio_types, type=str, default="mp3", help="set output extension")
+    parser.add_argument("--output-dir", action="store", metavar="DEST", help="mirror the source tree into DEST instead of converting in place; only files missing in DEST or newer than their copy are processed")
+    parser.add_argument("--prune", action="store_true", help="with --output-dir, remove files from DEST which have no source file; DEST must mirror the given directories, its subdirectories are pruned only with --recursive")
+    parser.add_argument("--dedup", action="store_true", help="encode files with identical content only once and create the other outputs from the first one")
+    parser.add_argument("--dedup-method", choices=("hardlink", "reflink", "copy"), default="reflink", help="how the outputs of duplicates are created: reflinks (default, falls back to copies), hardlinks (only with --output-dir) or copies")
+    parser.add_argument("--batch-small", action="store", type=int, metavar="KiB", default=0, help="convert files smaller than KiB in batches with a single ffmpeg process per batch, default=0 (disabled)")
+    parser.add_argument("--batch-files", action="store", type=int, metavar="N", default=32, help="maximum number of files in a batch, default=32")
+    parser.add_argument("--probe-jobs", action="store", type=int, metavar="N", help="number of concurrent probes, default is 4 times the number of CPUs")
+    parser.add_argument("--encode-jobs", action="store", type=int, metavar="N", help="number of concurrent encoders, default is the number of usable CPUs (respecting CPU affinity and cgroup quota)")
+    parser.add_argument("--adaptive", action="store_true", help="adjust the number of concurrent encoders based on system pressure (PSI) and throughput, starting at --encode-jobs")
+    parser.add_argument("--min-jobs", action="store", type=int, metavar="N", default=1, help="minimum number of concurrent encoders in the adaptive mode, default=1")
+    parser.add_argument("--max-jobs", action="store", type=int, metavar="N", help="maximum number of concurrent encoders in the adaptive mode, default is twice the number of CPUs")
+    parser.add_argument("--schedule", choices=("fifo", "lpt"), default="fifo", help="order of processing: fifo (walk order, default) or lpt (largest files first within the look-ahead window)")
+    parser.add_argument("--lookahead", action="store", type=int, metavar="N", default=256, help="number of files considered for reordering by --schedule=lpt, default=256")
+    parser.add_argument("--prefetch", action="store", type=int, metavar="K", default=0, help="warm the page cache for up to K queued input files while others are being encoded, default=0 (disabled)")
+    parser.add_argument("--prefetch-budget", action="store", type=int, metavar="MiB", default=512, help="maximum total size of prefetched files which were not encoded yet, default=512")
+    parser.add_argument("--prefetch-mode", choices=("read", "fadvise"), default="read", help="prefetch by reading the files (default, works on FUSE/sshfs) or by posix_fadvise(WILLNEED)")
+    parser.add_argument("--journal", action="store", metavar="PATH", help="record the result for each file in a journal and skip files completed in previous runs")
+    parser.add_argument("--profile", action="store_true", help="measure time spent in each stage and print throughput and latency statistics")
+    parser.add_argument("--profile-trace", action="store", metavar="PATH", help="write per-file timings of each stage as NDJSON into PATH (implies --profile)")
+    parser.add_argument("--probe-cache", action="store_true", help="cache ffprobe results in an SQLite database")
+    parser.add_argument("--probe-cache-file", action="store", default=default_cache_path(), metavar="PATH", help="path of the --probe-cache database, default=%(default)s")
 
     args = parser.parse_args()
+    if args.output_dir and args.delete_after:
+        parser.error("--delete-after cannot be used with --output-dir")
+    if args.dedup and args.dedup_method == "hardlink" and not args.output_dir:
+        # hardlinked files in the library would share later tag changes
+        parser.error("--dedup-method=hardlink requires --output-dir")
+    if args.prune and not args.output_dir:
+        parser.error("--prune requires --output-dir")
+    if args.prune and not all(os.path.isdir(path) for path in args.path):
+        # the outputs of single files do not tell which part of DEST is mirrored
+        parser.error("--prune requires directory paths")
 
     tmp = TempFiles()
     main = Main(args)
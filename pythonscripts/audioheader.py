@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+
+"""
+Pure-Python reader of audio headers, used as a fast path for getting the
+codec and average bitrate without spawning ffprobe. Handles MP3 (Xing/Info,
+VBRI and CBR frames), FLAC and Ogg Vorbis/Opus; for anything else
+read_audio_header() returns None and callers should fall back to ffprobe.
+"""
+
+import os
+import struct
+
+HEADER_READ_SIZE = 8192
+OGG_TAIL_READ_SIZE = 65536
+
+MP3_BITRATES = {
+    # (version is MPEG-1, layer): kb/s for bitrate index 0..14
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),   # MPEG-1
+    2: (22050, 24000, 16000),   # MPEG-2
+    0: (11025, 12000, 8000),    # MPEG-2.5
+}
+
+
+def _id3v2_size(header):
+    if header[:3] != b"ID3" or len(header) < 10:
+        return 0
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    # footer present
+    if header[5] & 0x10:
+        size += 10
+    return size + 10
+
+
+def _mp3_frame_header(buf, offset):
+    """ Returns (frame length, samples per frame, sample rate, bit rate, channels, mpeg1)
+        or None if there is no valid frame header at 'offset'.
+    """
+    if offset + 4 > len(buf) or buf[offset] != 0xFF or buf[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = (buf[offset + 1] >> 3) & 3
+    layer = 4 - ((buf[offset + 1] >> 1) & 3)
+    bitrate_index = buf[offset + 2] >> 4
+    rate_index = (buf[offset + 2] >> 2) & 3
+    padding = (buf[offset + 2] >> 1) & 1
+    channels = 1 if buf[offset + 3] >> 6 == 3 else 2
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 3 and not mpeg1:
+        samples = 576
+        length = 72 * bitrate // sample_rate + padding
+    else:
+        samples = 1152
+        length = 144 * bitrate // sample_rate + padding
+    return length, samples, sample_rate, bitrate, channels, mpeg1
+
+
+def _read_mp3(f, file_size, start, buf):
+    # find the first frame, requiring a second valid frame right after it to avoid false syncs
+    for offset in range(len(buf) - 4):
+        frame = _mp3_frame_header(buf, offset)
+        if frame is not None and (offset + frame[0] + 4 > len(buf) or _mp3_frame_header(buf, offset + frame[0]) is not None):
+            break
+    else:
+        return None
+    length, samples, sample_rate, bitrate, channels, mpeg1 = frame
+    audio_start = start + offset
+
+    # audio data ends before ID3v1 and APEv2 tags
+    f.seek(max(0, file_size - 160))
+    tail = f.read()
+    audio_end = file_size
+    if tail[-128:-125] == b"TAG":
+        audio_end -= 128
+        tail = tail[:-128]
+    if tail[-32:-24] == b"APETAGEX":
+        audio_end -= struct.unpack("<I", tail[-20:-16])[0] + 32
+    audio_bytes = audio_end - audio_start
+
+    # Xing/Info header is placed after the side information of the first frame
+    side_info = (32 if channels == 2 else 17) if mpeg1 else (17 if channels == 2 else 9)
+    xing = offset + 4 + side_info
+    frames = None
+    if buf[xing:xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack(">I", buf[xing + 4:xing + 8])[0]
+        pos = xing + 8
+        if flags & 1:
+            frames = struct.unpack(">I", buf[pos:pos + 4])[0]
+            pos += 4
+        if flags & 2:
+            audio_bytes = struct.unpack(">I", buf[pos:pos + 4])[0]
+        # the tag frame itself does not contain audio
+        if buf[xing:xing + 4] == b"Info" and frames:
+            # CBR, the bitrate in the frame headers is exact
+            frames = None
+    elif buf[offset + 36:offset + 40] == b"VBRI":
+        audio_bytes, frames = struct.unpack(">II", buf[offset + 46:offset + 54])
+
+    if frames:
+        duration = frames * samples / sample_rate
+        bitrate = int(audio_bytes * 8 / duration)
+    else:
+        duration = audio_bytes * 8 / bitrate
+    return {"codec_name": "mp3", "sample_rate": sample_rate, "channels": channels,
+            "duration": duration, "bit_rate": bitrate}
+
+
+def _read_flac(f, file_size, start, buf):
+    pos = start + 4
+    info = None
+    while True:
+        f.seek(pos)
+        block = f.read(38)
+        last = block[0] & 0x80
+        block_type = block[0] & 0x7F
+        block_length = int.from_bytes(block[1:4], "big")
+        if block_type == 0:
+            info = block[4:38]
+        pos += 4 + block_length
+        if last:
+            break
+    if info is None:
+        return None
+    packed = int.from_bytes(info[10:18], "big")
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 7) + 1
+    total_samples = packed & 0xFFFFFFFFF
+    if sample_rate == 0 or total_samples == 0:
+        return None
+    duration = total_samples / sample_rate
+    return {"codec_name": "flac", "sample_rate": sample_rate, "channels": channels,
+            "duration": duration, "bit_rate": int((file_size - pos) * 8 / duration)}
+
+
+def _read_ogg(f, file_size, start, buf):
+    serial = buf[14:18]
+    packet = buf[27 + buf[26]:]
+    if packet[:7] == b"\x01vorbis":
+        codec = "vorbis"
+        channels = packet[11]
+        sample_rate = struct.unpack("<I", packet[12:16])[0]
+        pre_skip = 0
+    elif packet[:8] == b"OpusHead":
+        codec = "opus"
+        channels = packet[9]
+        pre_skip = struct.unpack("<H", packet[10:12])[0]
+        # granule positions are always at 48 kHz
+        sample_rate = 48000
+    else:
+        return None
+
+    # duration is given by the granule position of the last page of the stream
+    f.seek(max(0, file_size - OGG_TAIL_READ_SIZE))
+    tail = f.read()
+    pos = len(tail)
+    while True:
+        pos = tail.rfind(b"OggS", 0, pos)
+        if pos < 0:
+            return None
+        if tail[pos + 14:pos + 18] == serial:
+            break
+    granule = struct.unpack("<q", tail[pos + 6:pos + 14])[0]
+    duration = (granule - pre_skip) / sample_rate
+    if duration <= 0:
+        return None
+    return {"codec_name": codec, "sample_rate": sample_rate, "channels": channels,
+            "duration": duration, "bit_rate": int(file_size * 8 / duration)}
+
+
+def read_audio_header(path):
+    """ Returns dict with "codec_name", "sample_rate", "channels", "duration"
+        and "bit_rate" (average, in b/s), or None if the format is not supported.
+    """
+    try:
+        with open(path, "rb") as f:
+            file_size = os.fstat(f.fileno()).st_size
+            buf = f.read(HEADER_READ_SIZE)
+            start = _id3v2_size(buf)
+            if start:
+                f.seek(start)
+                buf = f.read(HEADER_READ_SIZE)
+            if buf[:4] == b"fLaC":
+                return _read_flac(f, file_size, start, buf)
+            if buf[:4] == b"OggS" and start == 0:
+                return _read_ogg(f, file_size, start, buf)
+            # frame sync is too weak to detect MP3 in arbitrary files
+            if start or path.lower().endswith(".mp3"):
+                return _read_mp3(f, file_size, start, buf)
+            return None
+    except (OSError, struct.error, IndexError, ValueError, ZeroDivisionError):
+        return None
@@ -0,0 +1,21 @@
+#! /usr/bin/env python3
+
+"""
+Results file of the benchmark scripts: a JSON list of result objects, to which
+each run appends one. The file is replaced atomically, so an interrupted run
+does not corrupt the results of the previous ones.
+"""
+
+import os
+import json
+
+
+def save_results(path, result):
+    results = []
+    if os.path.exists(path):
+        with open(path) as f:
+            results = json.load(f)
+    results.append(result)
+    with open(path + ".tmp", "w") as f:
+        json.dump(results, f, indent=2)
+    os.replace(path + ".tmp", path)
@@ -1,12 +1,94 @@
 #! /usr/bin/env python3
 
+"""
+CPU budget of the current process: the number of CPUs it is allowed to run on
+(affinity mask), limited by the cgroup CPU quota, and optionally counting only
+one hardware thread per physical core.
+"""
+
+import os
+import math
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_quota():
+    """ Returns the CPU quota of the current cgroup as a (possibly fractional)
+        number of CPUs, or None if it is unlimited.
+    """
+    quotas = []
+    cgroup = _read("/proc/self/cgroup") or ""
+    for line in cgroup.splitlines():
+        hierarchy, controllers, path = line.split(":", 2)
+        if hierarchy == "0" and controllers == "":
+            # cgroup v2, the effective quota is the minimum over all ancestors
+            while True:
+                value = _read(os.path.join("/sys/fs/cgroup", path.lstrip("/"), "cpu.max"))
+                if value is not None:
+                    quota, period = value.split()
+                    if quota != "max":
+                        quotas.append(int(quota) / int(period))
+                if path in ("", "/"):
+                    break
+                path = os.path.dirname(path)
+        elif "cpu" in controllers.split(","):
+            # cgroup v1
+            for mount in ("cpu,cpuacct", "cpu"):
+                quota = _read(os.path.join("/sys/fs/cgroup", mount, path.lstrip("/"), "cpu.cfs_quota_us"))
+                period = _read(os.path.join("/sys/fs/cgroup", mount, path.lstrip("/"), "cpu.cfs_period_us"))
+                if quota is not None and period is not None:
+                    if int(quota) > 0:
+                        quotas.append(int(quota) / int(period))
+                    break
+    return min(quotas) if quotas else None
+
+
+def physical_cores(cpus):
+    """ Returns the number of physical cores among the logical CPUs in 'cpus'.
+    """
+    cores = set()
+    for cpu in cpus:
+        siblings = _read("/sys/devices/system/cpu/cpu%d/topology/thread_siblings_list" % cpu)
+        cores.add(siblings if siblings is not None else cpu)
+    return len(cores)
+
+
+def usable_cpus(smt=True):
+    """ Returns the number of CPUs the current process can effectively use.
+        With smt=False, hardware threads of the same core are counted once.
+    """
+    try:
+        cpus = os.sched_getaffinity(0)
+    except AttributeError:
+        cpus = range(os.cpu_count() or 1)
+    count = len(cpus) if smt else physical_cores(cpus)
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        count = min(count, math.ceil(quota))
+    return max(1, count)
+
+
+def split_budget(workers=None, threads=None, budget=None):
+    """ Split the CPU budget (by default usable_cpus()) between 'workers'
+        processes running 'threads' threads each. Missing values are derived
+        from the budget; returns tuple (workers, threads).
+    """
+    if budget is None:
+        budget = usable_cpus()
+    if workers is None and threads is None:
+        return budget, 1
+    if workers is None:
+        return max(1, budget // threads), threads
+    if threads is None:
+        return workers, max(1, budget // workers)
+    return workers, threads
+
+
 def cores_count():
-    f = open("/proc/cpuinfo")
-    for line in f.readlines():
-        if line.startswith("cpu cores"):
-            try:
-                _, n = line.split(":")
-                return int(n.strip())
-            except ValueError:
-                continue
-    return 1
+    return usable_cpus()
@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+
+"""
+Content-based deduplication helpers.
+
+ContentIndex groups files by their content. Files are compared by size and
+a hash of their beginning first; the full content is hashed only when two
+files collide on this cheap key. clone_file() materialises a copy of a file
+as a hardlink, a reflink or a plain copy, whichever is possible.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+import hashlib
+import threading
+
+PARTIAL_HASH_SIZE = 64 * 1024
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+def file_digest(path, limit=None):
+    h = hashlib.blake2b(digest_size=20)
+    remaining = limit
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(1024 * 1024 if remaining is None else min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            h.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return h.digest()
+
+
+class _Group:
+    """ Files sharing the same size and partial hash.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # first member, whose full hash was not needed yet
+        self.unhashed = None
+        # full hash -> (path, value)
+        self.members = {}
+
+
+class ContentIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.fullHashes = 0
+
+    def claim(self, path, size, value):
+        """ Register file 'path' of given size with an arbitrary 'value'.
+            Returns the value registered by the first file with the same content,
+            which is 'value' itself if there is no such file.
+        """
+        partial = file_digest(path, PARTIAL_HASH_SIZE)
+        with self.lock:
+            group = self.groups.setdefault((size, partial), _Group())
+        with group.lock:
+            if size <= PARTIAL_HASH_SIZE:
+                # the partial hash covers the whole file
+                return group.members.setdefault(partial, (path, value))[1]
+            if group.unhashed is None and not group.members:
+                group.unhashed = (path, value)
+                return value
+            if group.unhashed is not None:
+                first_path, first_value = group.unhashed
+                group.members[file_digest(first_path)] = group.unhashed
+                group.unhashed = None
+                self.fullHashes += 1
+            self.fullHashes += 1
+            return group.members.setdefault(file_digest(path), (path, value))[1]
+
+
+def clone_file(src, dst, method="hardlink"):
+    """ Replace 'dst' with a copy of 'src'. The preferred 'method' is one of
+        "hardlink", "reflink" and "copy"; when it is not possible (e.g. across
+        filesystems), the next one is tried. Returns the method that was used.
+    """
+    methods = ("hardlink", "reflink", "copy")
+    for method in methods[methods.index(method):]:
+        if method == "hardlink":
+            try:
+                os.unlink(dst)
+                os.link(src, dst)
+                return method
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+        elif method == "reflink":
+            try:
+                with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                shutil.copystat(src, dst)
+                return method
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY):
+                    raise
+        else:
+            shutil.copyfile(src, dst)
+            shutil.copystat(src, dst)
+            return method
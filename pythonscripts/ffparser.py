@@ -1,27 +1,130 @@
 #!/usr/bin/env python
 
 import json
+import asyncio
 import subprocess
-import shlex
 from pprint import pprint
 
+from pythonscripts.audioheader import read_audio_header
 
-ffprobe = "ffprobe -v quiet -print_format json -show_format -show_streams "
+
+ffprobe = ["ffprobe", "-v", "quiet", "-print_format", "json"]
+
+SECTIONS = ("audio", "video", "format")
+
+
+def ffprobe_entries(fields=None):
+    """ Returns list of ffprobe arguments selecting only 'fields', which is an
+        iterable of "option.attribute" strings (or just "option" to select all
+        attributes of the section), e.g. ("audio.bit_rate", "format.duration").
+        The full output (-show_format -show_streams) is selected for None.
+
+        When only audio or only video attributes are requested, ffprobe is
+        restricted to the first stream of that type, so attached pictures,
+        subtitles etc. are not even serialized.
+    """
+    if fields is None:
+        return ["-show_format", "-show_streams"]
+
+    # option -> set of attributes, None means all attributes
+    sections = {}
+    for field in fields:
+        option, _, attribute = field.partition(".")
+        if option not in SECTIONS:
+            raise ValueError("invalid field: '%s'" % field)
+        if not attribute:
+            sections[option] = None
+        elif option not in sections or sections[option] is not None:
+            sections.setdefault(option, set()).add(attribute)
+    # the bitrate of a stream is computed from the format bitrate when the
+    # stream does not have its own (e.g. in Matroska), see _getBitrate
+    for option in ("audio", "video"):
+        if sections.get(option) and "bit_rate" in sections[option] and sections.get("format", set()) is not None:
+            sections.setdefault("format", set()).add("bit_rate")
+
+    entries = []
+    if "format" in sections:
+        if sections["format"] is None:
+            entries.append("format")
+        else:
+            entries.append("format=" + ",".join(sorted(sections["format"])))
+    streams = [option for option in ("audio", "video") if option in sections]
+    if streams:
+        if any(sections[option] is None for option in streams):
+            entries.append("stream")
+        else:
+            attributes = {"codec_type"}
+            for option in streams:
+                attributes |= sections[option]
+            entries.append("stream=" + ",".join(sorted(attributes)))
+    args = ["-show_entries", ":".join(entries)]
+    if len(streams) == 1:
+        args += ["-select_streams", streams[0][0] + ":0"]
+    return args
 
 
 class FFprobeParser:
-    def __init__(self, path):
-        self.data = json.loads(subprocess.check_output(ffprobe + shlex.quote(path), shell=True, universal_newlines=True))
+    def __init__(self, path, cache=None, fields=None, data=None):
+        """ 'cache' is an optional ProbeCache object, ffprobe is run only
+            when the file is not cached or has been modified
+            'fields' is an optional iterable of "option.attribute" strings
+            declaring the attributes needed by the caller, see ffprobe_entries
+            'data' is the already parsed ffprobe output, used by probe()
+        """
+        self.path = path
+        self.source = "ffprobe"
+        self.data = data
+        if self.data is None:
+            args = ffprobe_entries(fields)
+            key, self.data = self._lookup(path, cache, args)
+            if self.data is not None:
+                self.source = "cache"
+            else:
+                output = subprocess.check_output(ffprobe + args + [path], universal_newlines=True)
+                self.data = self._store(path, cache, args, key, output)
 
-        self.format = self.data["format"]
+        self.format = self.data.get("format", {})
         self.audio = None
         self.video = None
-        for stream in self.data["streams"]:
+        for stream in self.data.get("streams", []):
             if self.audio is None and stream["codec_type"] == "audio":
                 self.audio = stream
             if self.video is None and stream["codec_type"] == "video":
                 self.video = stream
 
+    @classmethod
+    async def probe(cls, path, cache=None, fields=None):
+        """ Asynchronous variant of the constructor for callers running in an
+            event loop, ffprobe is run with asyncio.create_subprocess_exec
+        """
+        args = ffprobe_entries(fields)
+        key, data = cls._lookup(path, cache, args)
+        if data is not None:
+            parser = cls(path, data=data)
+            parser.source = "cache"
+            return parser
+        cmd = ffprobe + args + [path]
+        proc = await asyncio.create_subprocess_exec(*cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        output, _ = await proc.communicate()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+        return cls(path, data=cls._store(path, cache, args, key, output.decode()))
+
+    @staticmethod
+    def _lookup(path, cache, args):
+        if cache is None:
+            return None, None
+        # the key is taken before probing, so a file modified meanwhile is re-probed next time
+        key = cache.key(path)
+        return key, cache.get(path, key, entries=" ".join(args))
+
+    @staticmethod
+    def _store(path, cache, args, key, output):
+        data = json.loads(output)
+        if cache is not None:
+            cache.put(path, data, key, entries=" ".join(args))
+        return data
+
     def _get(self, option, attribute):
         return getattr(self, option)[attribute]
 
@@ -30,11 +133,15 @@ class FFprobeParser:
             try:
                 return int(self._get("audio", "bit_rate"))
             except:
+                if self.video is None:
+                    return self._getBitrate("format")
                 return int(self._getBitrate("format")) - int(self._getBitrate("video"))
         elif option == "video":
             try:
                 return int(self._get("video", "bit_rate"))
             except:
+                if self.audio is None:
+                    return self._getBitrate("format")
                 return int(self._getBitrate("format")) - int(self._getBitrate("audio"))
         elif option == "format":
             try:
@@ -60,3 +167,31 @@ class FFprobeParser:
         """
         pprint(getattr(self, option, self.data))
 
+
+# entries key of the bitrates stored by get_audio_bitrate in the ProbeCache
+BITRATE_ENTRIES = "audio.bit_rate"
+
+
+def get_audio_bitrate(path, cache=None):
+    """ Returns tuple (bit_rate, source), where 'source' is one of "header",
+        "cache" or "ffprobe" depending on how the bitrate was obtained.
+
+        'cache' is an optional ProbeCache object. It is checked before the
+        file is opened and the bitrate is stored in it whatever the source,
+        so an unchanged file costs only a stat call.
+    """
+    key = None
+    if cache is not None:
+        key = cache.key(path)
+        data = cache.get(path, key, entries=BITRATE_ENTRIES)
+        if data is not None:
+            return data["bit_rate"], "cache"
+    header = read_audio_header(path)
+    if header is not None:
+        bit_rate, source = header["bit_rate"], "header"
+    else:
+        bit_rate = FFprobeParser(path, fields=("audio.bit_rate",)).get("audio", "bit_rate")
+        source = "ffprobe"
+    if cache is not None:
+        cache.put(path, {"bit_rate": bit_rate}, key, entries=BITRATE_ENTRIES)
+    return bit_rate, source
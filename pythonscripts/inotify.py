@@ -0,0 +1,283 @@
+#! /usr/bin/env python3
+
+"""
+Minimal ctypes wrapper of the Linux inotify API.
+
+The inotify file descriptor is non-blocking, so it can be registered in an
+asyncio event loop with loop.add_reader() and read_events() called when it is
+readable. TreeWatcher builds debounced change notifications for whole
+directory trees on top of it.
+"""
+
+import os
+import time
+import errno
+import asyncio
+import ctypes
+import ctypes.util
+import struct
+from collections import namedtuple
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event without the variable-length name
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+# 'path' is the path of the watched directory, 'name' the name of the file in it (or "")
+Event = namedtuple("Event", ["wd", "mask", "cookie", "path", "name"])
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.inotify_init1.argtypes = [ctypes.c_int]
+        _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return _libc
+
+
+def _check(result, path=None):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+    return result
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = _get_libc()
+        self.fd = _check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        # watch descriptor -> path of the watched directory
+        self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """ Add a watch for 'path' and return its watch descriptor. Adding a watch
+            for an inode which is already watched updates its path.
+        """
+        wd = _check(self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask), path)
+        self.watches[wd] = path
+        return wd
+
+    def rm_watch(self, wd):
+        self.watches.pop(wd, None)
+        _check(self.libc.inotify_rm_watch(self.fd, wd))
+
+    def read_events(self):
+        """ Return the list of pending events, empty if there are none.
+        """
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            path = self.watches.get(wd, "")
+            if mask & IN_IGNORED:
+                # the watch was removed explicitly or the directory was deleted
+                self.watches.pop(wd, None)
+            events.append(Event(wd, mask, cookie, path, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+            self.watches.clear()
+
+
+def _is_within(path, directory):
+    return path == directory or path.startswith(directory.rstrip("/") + "/")
+
+
+class TreeWatcher:
+    """ Watch directory trees and report the directories in which files were
+        written, once the writes have settled for 'settle' seconds.
+
+        Each root has its own inotify instance, so an overflow of the kernel
+        event queue (IN_Q_OVERFLOW) affects only one root, which is then
+        reported as a subtree to be rescanned. The map of pending directories
+        is bounded by 'max_pending': when it is full, the new directory and the
+        pending directories sharing an ancestor with it are coalesced into one
+        subtree entry for that ancestor.
+    """
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR | IN_EXCL_UNLINK
+
+    def __init__(self, roots, recursive=True, settle=10.0, max_pending=4096, extensions=None, log=print):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.recursive = recursive
+        self.settle = settle
+        self.max_pending = max_pending
+        if isinstance(extensions, str):
+            extensions = (extensions,)
+        self.extensions = tuple(extensions) if extensions is not None else None
+        self.log = log
+        # directory -> [deadline, subtree, set of written files]
+        self.pending = {}
+        self.instances = []
+        self.countOverflows = 0
+        self.countCoalesced = 0
+        self._wakeup = None
+        self._loop = None
+
+    def start(self):
+        """ Add the watches and register the inotify descriptors in the running event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        for root in self.roots:
+            inotify = Inotify()
+            self.instances.append(inotify)
+            self._watch_tree(inotify, root)
+            self._loop.add_reader(inotify.fileno(), self._read, root, inotify)
+
+    def close(self):
+        for inotify in self.instances:
+            if self._loop is not None:
+                self._loop.remove_reader(inotify.fileno())
+            inotify.close()
+        self.instances = []
+
+    def _watch_tree(self, inotify, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            try:
+                inotify.add_watch(dirpath, self.MASK)
+            except OSError as e:
+                # e.g. the directory was removed meanwhile or max_user_watches was reached
+                self.log("cannot watch {}: {}".format(dirpath, e))
+            if not self.recursive:
+                break
+
+    def _read(self, root, inotify):
+        for event in inotify.read_events():
+            if event.mask & IN_Q_OVERFLOW:
+                self.countOverflows += 1
+                self.log("inotify event queue overflow, rescanning {}".format(root))
+                # directories created meanwhile are not watched yet
+                self._watch_tree(inotify, root)
+                self._mark(root, subtree=True)
+            elif not event.path or event.mask & IN_IGNORED:
+                continue
+            elif event.mask & IN_ISDIR:
+                if self.recursive and event.mask & (IN_CREATE | IN_MOVED_TO):
+                    path = os.path.join(event.path, event.name)
+                    self._watch_tree(inotify, path)
+                    # a moved directory is not empty
+                    self._mark(path, subtree=True)
+            elif event.mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                if self.extensions is None or event.name.endswith(self.extensions):
+                    self._mark(event.path, filename=os.path.join(event.path, event.name))
+
+    def mark(self, directory, files=()):
+        """ Report writes of 'files' in 'directory' as if their events were
+            received now, e.g. to have events that were held back by the caller
+            reported again once they settle.
+        """
+        if not files:
+            self._mark(directory)
+        for filename in files:
+            self._mark(directory, filename=filename)
+
+    def _root_of(self, path):
+        for root in self.roots:
+            if _is_within(path, root):
+                return root
+        return path
+
+    def _mark(self, path, subtree=False, filename=None):
+        deadline = time.monotonic() + self.settle
+        self._wakeup.set()
+        for pending, entry in self.pending.items():
+            if entry[1] and _is_within(path, pending):
+                # already covered by a pending subtree
+                entry[0] = deadline
+                return
+        if subtree:
+            for pending in [p for p in self.pending if _is_within(p, path)]:
+                del self.pending[pending]
+        entry = self.pending.get(path)
+        if entry is None and len(self.pending) >= self.max_pending:
+            path = self._coalesce(path)
+            subtree = True
+            entry = self.pending.get(path)
+        if entry is None:
+            entry = self.pending[path] = [deadline, subtree, set()]
+        entry[0] = deadline
+        entry[1] = entry[1] or subtree
+        if filename is not None and not entry[1]:
+            entry[2].add(filename)
+
+    def _coalesce(self, path):
+        """ Replace the pending entries under the nearest ancestor of 'path' that
+            has any with one subtree entry and return the ancestor.
+        """
+        root = self._root_of(path)
+        ancestor = os.path.dirname(path) if path != root else path
+        while True:
+            merged = [p for p in self.pending if _is_within(p, ancestor)]
+            if merged or ancestor == root or os.path.dirname(ancestor) == ancestor:
+                break
+            ancestor = os.path.dirname(ancestor)
+        for pending in merged:
+            del self.pending[pending]
+        self.countCoalesced += len(merged)
+        return ancestor
+
+    async def changes(self):
+        """ Asynchronous generator of tuples (directory, subtree, files) for the
+            directories whose writes have settled. If 'subtree' is True, the whole
+            subtree must be rescanned, otherwise 'files' is the set of written files.
+        """
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = sorted(path for path, entry in self.pending.items() if entry[0] <= now)
+            for path in due:
+                entry = self.pending.pop(path, None)
+                if entry is not None:
+                    yield path, entry[1], entry[2]
+            timeout = None
+            if self.pending:
+                timeout = max(0, min(entry[0] for entry in self.pending.values()) - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+
+"""
+Append-only journal of per-file decisions, used to resume interrupted runs.
+
+Every record is one JSON line. Records are flushed to the OS immediately (so
+they survive a killed process), but fsync is done only in batches. When the
+journal is loaded, the last record of each path wins and records truncated
+by a crash are ignored.
+"""
+
+import os
+import json
+import threading
+import time
+import atexit
+
+
+def stat_key(st):
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+class Journal:
+    def __init__(self, path, sync_every=100, sync_interval=5.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.records = {}
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        torn = False
+        if os.path.exists(path):
+            torn = self._load()
+        self._file = open(path, "a")
+        if torn:
+            # terminate the torn line, so that the next record is not glued to it
+            self._file.write("\n")
+            self._file.flush()
+        atexit.register(self.close)
+
+    def _load(self):
+        """ Load the records, returns True if the last line is not terminated.
+        """
+        line = "\n"
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # partially written record from an interrupted run
+                    continue
+                self.records[record["path"]] = record
+        return not line.endswith("\n")
+
+    def get(self, path):
+        return self.records.get(path)
+
+    def is_done(self, path, st):
+        """ Returns True if 'path' was already skipped or converted and it has not
+            changed since. 'st' is the current os.stat_result of the file.
+        """
+        record = self.records.get(path)
+        if record is None or record["status"] not in ("skipped", "converted"):
+            return False
+        key = stat_key(st)
+        return key == record.get("stat") or key == record.get("output_stat")
+
+    def unfinished(self):
+        """ Returns records of files whose processing has started but never finished.
+        """
+        return [r for r in self.records.values() if r["status"] == "started"]
+
+    def record(self, path, status, st=None, **fields):
+        record = {"path": path, "status": status}
+        if st is not None:
+            record["stat"] = stat_key(st)
+        record.update(fields)
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self.records[path] = record
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._sync()
+            self._file.close()
@@ -0,0 +1,321 @@
+#! /usr/bin/env python3
+
+"""
+EBU R128 (ITU-R BS.1770) loudness analysis for ReplayGain 2.0.
+
+The audio is decoded by ffmpeg into a pipe of 32-bit float samples at 48 kHz
+and processed in chunks, so the memory use does not depend on the length of
+the track. Each chunk is K-weighted with the IIR filters from BS.1770 (the
+filter state is carried between chunks), the mean square is computed for
+100 ms sub-blocks and the loudness of 400 ms blocks (75 % overlap) is added
+to a histogram with 0.01 LU bins. The integrated (gated) loudness is computed
+from the histogram, which makes it possible to get the album loudness by
+adding the histograms of its tracks instead of analysing the tracks again.
+
+The filtering is done with scipy.signal on NumPy arrays.
+
+The results can be kept in a sidecar file in the album directory (see
+AnalysisCache), so that adding a track to an album costs the analysis of
+that track and the aggregation of the cached histograms.
+"""
+
+import os
+import json
+import tempfile
+import subprocess
+
+import numpy as np
+from scipy.signal import sosfilt, firwin, lfilter
+
+from pythonscripts.audioheader import read_audio_header
+from pythonscripts.ffparser import FFprobeParser
+
+SAMPLE_RATE = 48000
+CHUNK_FRAMES = SAMPLE_RATE
+# bytes of ffmpeg's error output kept for the error message
+STDERR_TAIL = 4096
+SUBBLOCK_FRAMES = SAMPLE_RATE // 10     # 100 ms, the hop between blocks
+BLOCK_SUBBLOCKS = 4                     # 400 ms blocks
+
+REFERENCE_LOUDNESS = -18.0              # ReplayGain 2.0 reference level in LUFS
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+HISTOGRAM_STEP = 0.01
+HISTOGRAM_MAX = 10.0
+HISTOGRAM_BINS = int(round((HISTOGRAM_MAX - ABSOLUTE_GATE) / HISTOGRAM_STEP))
+
+# K-weighting at 48 kHz: high shelf followed by high pass (BS.1770-4, table 1 and 2)
+K_WEIGHTING = np.array([
+    [1.53512485958697, -2.69169618940638, 1.19839281085285, 1.0, -1.69065929318241, 0.73248077421585],
+    [1.0, -2.0, 1.0, 1.0, -1.99004745483398, 0.99007225036621],
+])
+
+# channel weights for 5.1 in the ffmpeg channel order (FL FR FC LFE BL BR)
+SURROUND_WEIGHTS = np.array([1.0, 1.0, 1.0, 0.0, 1.41, 1.41])
+
+TRUE_PEAK_OVERSAMPLING = 4
+TRUE_PEAK_TAPS = 48
+
+
+def channel_weights(channels):
+    if channels == len(SURROUND_WEIGHTS):
+        return SURROUND_WEIGHTS
+    return np.ones(channels)
+
+
+def power_to_lufs(power):
+    with np.errstate(divide="ignore"):
+        return -0.691 + 10 * np.log10(power)
+
+
+def lufs_to_power(lufs):
+    return 10 ** ((lufs + 0.691) / 10)
+
+
+# loudness of the center of each histogram bin and the corresponding block power
+_BIN_LUFS = ABSOLUTE_GATE + HISTOGRAM_STEP * (np.arange(HISTOGRAM_BINS) + 0.5)
+_BIN_POWER = lufs_to_power(_BIN_LUFS)
+
+
+class LoudnessResult:
+    """ Histogram of block loudness and the peak of a track or an album.
+    """
+    def __init__(self, histogram=None, peak=0.0):
+        self.histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64) if histogram is None else histogram
+        self.peak = peak
+
+    @classmethod
+    def merge(cls, results):
+        """ Aggregate track results into the album result.
+        """
+        album = cls()
+        for result in results:
+            album.histogram += result.histogram
+            album.peak = max(album.peak, result.peak)
+        return album
+
+    def to_json(self):
+        """ Returns a JSON-serializable dict; the histogram is stored as the run
+            of bins between the first and the last non-zero bin.
+        """
+        nonzero = np.flatnonzero(self.histogram)
+        if len(nonzero) == 0:
+            return {"peak": self.peak, "offset": 0, "counts": []}
+        first, last = nonzero[0], nonzero[-1]
+        return {"peak": self.peak, "offset": int(first), "counts": self.histogram[first:last + 1].tolist()}
+
+    @classmethod
+    def from_json(cls, data):
+        histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        counts = data["counts"]
+        histogram[data["offset"]:data["offset"] + len(counts)] = counts
+        return cls(histogram, data["peak"])
+
+    @property
+    def loudness(self):
+        """ Integrated loudness in LUFS with the absolute and relative gating,
+            None if there is no block above the absolute gate.
+        """
+        counts = self.histogram
+        total = counts.sum()
+        if total == 0:
+            return None
+        relative_gate = power_to_lufs(np.dot(counts, _BIN_POWER) / total) + RELATIVE_GATE
+        gated = counts[_BIN_LUFS >= relative_gate]
+        return float(power_to_lufs(np.dot(gated, _BIN_POWER[_BIN_LUFS >= relative_gate]) / gated.sum()))
+
+    @property
+    def gain(self):
+        """ ReplayGain 2.0 gain in dB, 0 for silent tracks.
+        """
+        loudness = self.loudness
+        if loudness is None:
+            return 0.0
+        return REFERENCE_LOUDNESS - loudness
+
+
+class LoudnessMeter:
+    """ Streaming meter, samples are fed by feed() as float arrays of shape (frames, channels).
+    """
+    def __init__(self, channels, true_peak=False):
+        self.channels = channels
+        self.weights = channel_weights(channels)
+        self.true_peak = true_peak
+        self.result = LoudnessResult()
+        self._zi = np.zeros((len(K_WEIGHTING), 2, channels))
+        # samples not yet forming a complete sub-block
+        self._rest = np.zeros((0, channels))
+        # mean squares of the last BLOCK_SUBBLOCKS - 1 sub-blocks
+        self._last = np.zeros(0)
+        if true_peak:
+            # polyphase interpolation filter: phase k computes the samples at offset k / TRUE_PEAK_OVERSAMPLING
+            fir = firwin(TRUE_PEAK_TAPS * TRUE_PEAK_OVERSAMPLING, 1.0 / TRUE_PEAK_OVERSAMPLING) * TRUE_PEAK_OVERSAMPLING
+            self._phases = [fir[k::TRUE_PEAK_OVERSAMPLING] for k in range(TRUE_PEAK_OVERSAMPLING)]
+            self._phases_zi = [np.zeros((TRUE_PEAK_TAPS - 1, channels)) for _ in self._phases]
+
+    def _peak(self, samples):
+        peak = float(np.abs(samples).max())
+        if not self.true_peak:
+            return peak
+        for k, phase in enumerate(self._phases):
+            interpolated, self._phases_zi[k] = lfilter(phase, 1.0, samples, axis=0, zi=self._phases_zi[k])
+            peak = max(peak, float(np.abs(interpolated).max()))
+        return peak
+
+    def feed(self, samples):
+        if len(samples) == 0:
+            return
+        self.result.peak = max(self.result.peak, self._peak(samples))
+        weighted, self._zi = sosfilt(K_WEIGHTING, samples, axis=0, zi=self._zi)
+        weighted = np.concatenate((self._rest, weighted))
+        count = len(weighted) // SUBBLOCK_FRAMES
+        self._rest = weighted[count * SUBBLOCK_FRAMES:]
+        if count == 0:
+            return
+        squares = (weighted[:count * SUBBLOCK_FRAMES] ** 2).reshape(count, SUBBLOCK_FRAMES, self.channels)
+        subblocks = squares.mean(axis=1) @ self.weights
+        subblocks = np.concatenate((self._last, subblocks))
+        if len(subblocks) >= BLOCK_SUBBLOCKS:
+            # mean of each run of BLOCK_SUBBLOCKS consecutive sub-blocks
+            cumsum = np.concatenate(([0.0], np.cumsum(subblocks)))
+            blocks = (cumsum[BLOCK_SUBBLOCKS:] - cumsum[:-BLOCK_SUBBLOCKS]) / BLOCK_SUBBLOCKS
+            self._add_blocks(power_to_lufs(blocks))
+        self._last = subblocks[-(BLOCK_SUBBLOCKS - 1):]
+
+    def _add_blocks(self, lufs):
+        lufs = lufs[lufs > ABSOLUTE_GATE]
+        bins = np.minimum(((lufs - ABSOLUTE_GATE) / HISTOGRAM_STEP).astype(np.int64), HISTOGRAM_BINS - 1)
+        self.result.histogram += np.bincount(bins, minlength=HISTOGRAM_BINS)
+
+
+def audio_channels(path):
+    """ Return the number of channels of the first audio stream of 'path'.
+        Raises ValueError if it cannot be determined, e.g. there is no audio stream.
+    """
+    header = read_audio_header(path)
+    if header is not None and header.get("channels"):
+        return header["channels"]
+    try:
+        channels = FFprobeParser(path, fields=("audio.channels",)).get("audio", "channels")
+    except subprocess.CalledProcessError as e:
+        raise ValueError("ffprobe returned error status %d" % e.returncode) from e
+    if not channels:
+        raise ValueError("no audio stream found")
+    return int(channels)
+
+
+def analyze_file(path, true_peak=False, threads=1):
+    """ Decode the first audio stream of 'path' with ffmpeg and return its LoudnessResult.
+        'threads' is the number of decoder threads; the tracks are usually analysed
+        by concurrent processes, so ffmpeg's automatic thread count is not used.
+    """
+    channels = audio_channels(path)
+    meter = LoudnessMeter(channels, true_peak=true_peak)
+    cmd = ["ffmpeg", "-v", "error", "-nostdin", "-threads", str(threads), "-i", path, "-map", "0:a:0",
+           "-f", "f32le", "-acodec", "pcm_f32le", "-ar", str(SAMPLE_RATE), "-ac", str(channels), "-"]
+    chunk_bytes = CHUNK_FRAMES * channels * 4
+    pending = b""
+    # the error output goes to a file, a damaged input may produce more than
+    # a pipe buffer of it and ffmpeg would block while stdout is being read
+    with tempfile.TemporaryFile() as errfile:
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=errfile)
+        try:
+            while True:
+                data = proc.stdout.read(chunk_bytes)
+                if not data:
+                    break
+                data = pending + data
+                usable = len(data) - len(data) % (channels * 4)
+                pending = data[usable:]
+                samples = np.frombuffer(data[:usable], dtype="<f4").reshape(-1, channels)
+                meter.feed(samples.astype(np.float64))
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            errfile.seek(max(0, errfile.seek(0, os.SEEK_END) - STDERR_TAIL))
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=errfile.read())
+    return meter.result
+
+
+class AnalysisCache:
+    """ Results of the track analysis stored in a sidecar file in the album directory.
+
+        Entries are keyed by the file name and validated by the size and mtime
+        of the file. The file is replaced atomically by save(). Only the methods
+        get() and put() may be called concurrently for different tracks.
+    """
+    FILE_NAME = ".replaygain-cache.json"
+    # bump when the analysis changes
+    VERSION = 1
+
+    def __init__(self, directory, true_peak=False):
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.true_peak = true_peak
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION and data.get("histogram_step") == HISTOGRAM_STEP:
+                self.entries = data["tracks"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get(self, path, st):
+        """ Returns the cached LoudnessResult, or None if the file is not cached
+            or was modified since it was analysed. 'st' is the os.stat_result of the file.
+        """
+        entry = self.entries.get(os.path.basename(path))
+        if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+            return None
+        # the sample peak cannot be used instead of the true peak and vice versa
+        if entry["true_peak"] != self.true_peak:
+            return None
+        return LoudnessResult.from_json(entry["result"])
+
+    def put(self, path, st, result):
+        """ 'st' must be taken before the analysis, so a file modified meanwhile is analysed again.
+        """
+        self.entries[os.path.basename(path)] = {
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "true_peak": self.true_peak,
+            "result": result.to_json(),
+        }
+        self.dirty = True
+
+    def refresh(self, path, st):
+        """ Update the stat of a file whose audio data did not change, e.g. after
+            writing its tags.
+        """
+        entry = self.entries.get(os.path.basename(path))
+        if entry is not None:
+            entry["size"] = st.st_size
+            entry["mtime_ns"] = st.st_mtime_ns
+            self.dirty = True
+
+    def save(self, paths=None):
+        """ Write the sidecar file if anything changed. When 'paths' is given,
+            entries of files which are not in the list are dropped.
+        """
+        if paths is not None:
+            names = set(os.path.basename(path) for path in paths)
+            for name in list(self.entries):
+                if name not in names:
+                    del self.entries[name]
+                    self.dirty = True
+        if not self.dirty:
+            return
+        data = {"version": self.VERSION, "histogram_step": HISTOGRAM_STEP, "tracks": self.entries}
+        fd, tmp = tempfile.mkstemp(prefix=self.FILE_NAME + ".", suffix=".tmp", dir=os.path.dirname(self.path))
+        try:
+            # mkstemp creates the file with mode 0600
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except:
+            os.remove(tmp)
+            raise
+        self.dirty = False
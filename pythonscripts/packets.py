@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+
+"""
+Streaming access to the packets of a stream. ffprobe is run with the
+line-oriented "compact" writer and the packets are parsed one line at a time,
+so the memory use does not depend on the length of the file. Keyframes can be
+collected into a KeyframeIndex, which is stored as two flat arrays of 64-bit
+integers and can be memory-mapped for seeking without parsing anything.
+"""
+
+import os
+import mmap
+import struct
+import bisect
+import subprocess
+from array import array
+from collections import namedtuple
+
+PACKET_ENTRIES = ("pts", "dts", "duration", "size", "pos", "flags")
+
+Packet = namedtuple("Packet", PACKET_ENTRIES)
+
+
+def _packet_value(value):
+    if value == "N/A":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def iter_packets(path, stream="v:0"):
+    """ Yield Packet tuples of the selected stream in file order. Missing
+        values are None, 'flags' is a string such as "K__" where "K" marks
+        a keyframe. Closing the generator early terminates ffprobe.
+    """
+    cmd = ["ffprobe", "-v", "error", "-select_streams", stream,
+           "-show_entries", "packet=" + ",".join(PACKET_ENTRIES),
+           "-of", "compact=p=0", path]
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, universal_newlines=True)
+    finished = False
+    try:
+        for line in proc.stdout:
+            fields = dict(item.split("=", 1) for item in line.rstrip("\n").split("|") if "=" in item)
+            yield Packet(*(_packet_value(fields.get(name, "N/A")) for name in PACKET_ENTRIES))
+        finished = True
+    finally:
+        if not finished:
+            proc.kill()
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def stream_time_base(path, stream="v:0"):
+    """ Returns the time base of the selected stream as (numerator, denominator).
+    """
+    output = subprocess.check_output(["ffprobe", "-v", "error", "-select_streams", stream,
+                                      "-show_entries", "stream=time_base", "-of", "csv=p=0", path],
+                                     universal_newlines=True)
+    numerator, denominator = output.split()[0].split("/")
+    return int(numerator), int(denominator)
+
+
+class KeyframeIndex:
+    """ Presentation timestamps and byte offsets of the keyframes of a stream,
+        sorted by the timestamp.
+
+        The file format is a 32-byte header (magic, number of keyframes, time
+        base) followed by the array of timestamps and the array of offsets,
+        all as native-endian 64-bit integers.
+    """
+    MAGIC = b"KFIDX001"
+    HEADER = struct.Struct("=8sqqq")
+
+    def __init__(self, time_base=(1, 1), pts=None, pos=None):
+        self.time_base = time_base
+        self.pts = array("q") if pts is None else pts
+        self.pos = array("q") if pos is None else pos
+        self._mmap = None
+
+    @classmethod
+    def build(cls, path, stream="v:0"):
+        """ Build the index by streaming the packets of 'stream' in 'path'.
+        """
+        index = cls(stream_time_base(path, stream))
+        for packet in iter_packets(path, stream):
+            if packet.flags is None or "K" not in packet.flags:
+                continue
+            pts = packet.pts if packet.pts is not None else packet.dts
+            if pts is None:
+                continue
+            index.add(pts, packet.pos if packet.pos is not None else -1)
+        return index
+
+    def add(self, pts, pos):
+        if self.pts and pts < self.pts[-1]:
+            # out-of-order timestamps are rare, keep the arrays sorted
+            i = bisect.bisect_right(self.pts, pts)
+            self.pts.insert(i, pts)
+            self.pos.insert(i, pos)
+        else:
+            self.pts.append(pts)
+            self.pos.append(pos)
+
+    def __len__(self):
+        return len(self.pts)
+
+    def seconds(self, pts):
+        return pts * self.time_base[0] / self.time_base[1]
+
+    def seek(self, seconds):
+        """ Returns (pts, pos) of the last keyframe at or before 'seconds',
+            or None if there is no such keyframe.
+        """
+        target = seconds * self.time_base[1] // self.time_base[0]
+        i = bisect.bisect_right(self.pts, target)
+        if i == 0:
+            return None
+        return self.pts[i - 1], self.pos[i - 1]
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(self.pts), *self.time_base))
+            self.pts.tofile(f)
+            self.pos.tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Memory-map an index saved by save(). The arrays are read-only views
+            of the mapping, pages are loaded only when a seek touches them.
+        """
+        with open(path, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, numerator, denominator = cls.HEADER.unpack_from(mapping)
+        if magic != cls.MAGIC or len(mapping) != cls.HEADER.size + 16 * count:
+            mapping.close()
+            raise ValueError("invalid keyframe index: '%s'" % path)
+        view = memoryview(mapping)[cls.HEADER.size:].cast("q")
+        index = cls((numerator, denominator), view[:count], view[count:])
+        index._mmap = mapping
+        return index
+
+    def close(self):
+        if self._mmap is not None:
+            self.pts.release()
+            self.pos.release()
+            self._mmap.close()
+            self._mmap = None
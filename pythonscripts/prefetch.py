@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+
+"""
+Read-ahead of queued input files into the page cache.
+
+Files are announced by enqueue() when they are queued for processing. While
+earlier files are being processed, a small thread pool warms the page cache
+for up to 'max_files' queued files whose total size fits into the memory
+budget, either by posix_fadvise(WILLNEED) or by reading the files. The caller
+reports the start and the end of processing of each file by claim() and
+release(), which also gives the prefetch hit rate.
+"""
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class Prefetcher:
+    def __init__(self, max_files, budget, mode="read", workers=2):
+        self.max_files = max_files
+        self.budget = budget
+        self.mode = mode
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        # files waiting for prefetch: deque of (path, size)
+        self.waiting = deque()
+        # prefetched files: path -> (size, future)
+        self.active = {}
+        self.used = 0
+        self.countPrefetched = 0
+        self.bytesPrefetched = 0
+        self.countHits = 0
+        self.countLate = 0
+        self.countMisses = 0
+
+    def _warm(self, path, size):
+        if self.mode == "fadvise":
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        else:
+            with open(path, "rb", buffering=0) as f:
+                while f.read(READ_CHUNK_SIZE):
+                    pass
+
+    def _fill(self):
+        # called with self.lock held
+        while self.waiting and len(self.active) < self.max_files:
+            path, size = self.waiting[0]
+            if size > self.budget:
+                # would never fit
+                self.waiting.popleft()
+                continue
+            if self.used + size > self.budget:
+                break
+            self.waiting.popleft()
+            self.used += size
+            self.countPrefetched += 1
+            self.bytesPrefetched += size
+            self.active[path] = (size, self.executor.submit(self._warm, path, size))
+
+    def enqueue(self, path, size):
+        with self.lock:
+            self.waiting.append((path, size))
+            self._fill()
+
+    def claim(self, path):
+        """ Processing of the file starts now.
+        """
+        with self.lock:
+            entry = self.active.get(path)
+            if entry is None:
+                self.countMisses += 1
+                # do not prefetch a file which is already being processed
+                self.waiting = deque(item for item in self.waiting if item[0] != path)
+            elif entry[1].done():
+                self.countHits += 1
+            else:
+                self.countLate += 1
+
+    def release(self, path):
+        """ Processing of the file has finished, its share of the budget is freed.
+        """
+        with self.lock:
+            entry = self.active.pop(path, None)
+            if entry is not None:
+                self.used -= entry[0]
+            self._fill()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+
+"""
+Adaptive concurrency limit driven by Linux pressure stall information (PSI).
+
+AdaptiveLimit is used like an asyncio semaphore around each job. When its
+controller is running, it periodically samples /proc/pressure/{cpu,io,memory}
+and the throughput of finished jobs: the limit is lowered when the system is
+under pressure and raised (within the bounds) when there are jobs waiting,
+the system is idle and raising the limit previously increased the throughput.
+"""
+
+import asyncio
+
+
+def read_pressure(resource):
+    """ Returns the "some avg10" value (percentage of time in the last 10 seconds
+        when some tasks were stalled on 'resource'), or None if PSI is not available.
+    """
+    try:
+        with open("/proc/pressure/" + resource) as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] == "some":
+                    return float(dict(field.split("=") for field in fields[1:])["avg10"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+class AdaptiveLimit:
+    def __init__(self, minimum, maximum, initial=None, interval=5.0, thresholds=None, log=print):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.maximum, max(self.minimum, initial if initial is not None else self.maximum))
+        self.interval = interval
+        self.thresholds = thresholds or {"cpu": 20.0, "io": 20.0, "memory": 10.0}
+        self.log = log
+        self.changes = 0
+        self._active = 0
+        self._waiting = 0
+        self._done = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            self._waiting += 1
+            try:
+                await self._condition.wait_for(lambda: self._active < self.limit)
+            finally:
+                self._waiting -= 1
+            self._active += 1
+
+    async def __aexit__(self, *exc):
+        async with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def job_done(self, amount=1):
+        """ Account a finished job for the throughput measurement, 'amount'
+            can be e.g. the number of processed bytes.
+        """
+        self._done += amount
+
+    async def _set_limit(self, limit, reason):
+        self.log("concurrency {} -> {} ({})".format(self.limit, limit, reason))
+        self.changes += 1
+        async with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    async def control(self):
+        """ Controller loop, run it as a task and cancel it when the work is done.
+        """
+        previous_throughput = None
+        last_step = 0
+        hold = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            throughput = self._done / self.interval
+            self._done = 0
+            pressure = {resource: read_pressure(resource) for resource in self.thresholds}
+            reason = ", ".join("{} {:.1f}%".format(r, p) for r, p in pressure.items() if p is not None)
+            reason += "{}{:.1f}/s".format(", " if reason else "", throughput)
+            hold = max(0, hold - 1)
+
+            step = 0
+            if any(p is not None and p > self.thresholds[r] for r, p in pressure.items()):
+                step = -1
+            elif last_step > 0 and previous_throughput is not None and throughput <= 1.05 * previous_throughput:
+                # the last increase did not help, go back and do not try again for a while
+                step = -1
+                hold = 6
+            elif self._waiting > 0 and hold == 0 and \
+                    all(p is None or p < self.thresholds[r] / 2 for r, p in pressure.items()):
+                step = 1
+
+            limit = min(self.maximum, max(self.minimum, self.limit + step))
+            last_step = limit - self.limit
+            previous_throughput = throughput
+            if limit != self.limit:
+                await self._set_limit(limit, reason)
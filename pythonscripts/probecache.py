@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+
+"""
+Persistent cache of ffprobe results, stored in an SQLite database.
+
+Entries are keyed by the (st_dev, st_ino) pair of the probed file and by the
+selection of ffprobe entries that was requested, and validated by the size and
+mtime of the file, so an unchanged file costs only a stat call. The number
+of entries is capped and the least recently used entries are evicted first.
+
+The database may be shared by concurrent processes: every write is committed
+right away (access times of hits are written in small batches) and errors of
+the database, e.g. when it stays locked by another process for too long, are
+treated as cache misses.
+"""
+
+import os
+import json
+import sqlite3
+import time
+
+from pythonscripts.sqlitedb import SQLiteDatabase, cache_path
+
+# number of hits whose access times are written in one transaction
+TOUCH_BATCH = 100
+
+
+def default_cache_path(name="ffprobe.sqlite"):
+    return cache_path(name)
+
+
+class ProbeCache(SQLiteDatabase):
+    SCHEMA_VERSION = 2
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS probes (
+            dev INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            entries TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            atime REAL NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (dev, ino, entries)
+        )""",
+        "CREATE INDEX IF NOT EXISTS probes_atime ON probes (atime)",
+    )
+
+    def __init__(self, path=None, max_entries=1000000):
+        super().__init__(path or default_cache_path())
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._inserts = 0
+        # (atime, dev, ino, entries) of hits whose atime is not written yet
+        self._touched = []
+
+    @staticmethod
+    def key(path):
+        st = os.stat(path)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, path, key=None, entries=""):
+        """ Return the cached data for 'path', or None if the file is not cached
+            or was modified since it was cached. 'entries' identifies the subset
+            of ffprobe output that was requested (empty for the full output).
+        """
+        dev, ino, size, mtime_ns = key or self.key(path)
+        with self._lock:
+            try:
+                row = self._db.execute("SELECT size, mtime_ns, data FROM probes WHERE dev=? AND ino=? AND entries=?",
+                                       (dev, ino, entries)).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row is None or row[0] != size or row[1] != mtime_ns:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched.append((time.time(), dev, ino, entries))
+            if len(self._touched) >= TOUCH_BATCH:
+                self._flush_touched()
+        return json.loads(row[2])
+
+    def put(self, path, data, key=None, entries=""):
+        dev, ino, size, mtime_ns = key or self.key(path)
+        with self._lock:
+            try:
+                self._db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (dev, ino, entries, size, mtime_ns, time.time(), json.dumps(data)))
+                self._inserts += 1
+                # evict in batches, not on every insert
+                if self._inserts % 1000 == 0:
+                    self._evict()
+            except sqlite3.Error:
+                # the entry is simply not cached
+                pass
+
+    def _flush_touched(self):
+        touched, self._touched = self._touched, []
+        # access times are only a hint for the eviction, failures are ignored
+        self._executemany("UPDATE probes SET atime=? WHERE dev=? AND ino=? AND entries=?", touched)
+
+    def _evict(self):
+        count = self._db.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute("DELETE FROM probes WHERE rowid IN "
+                             "(SELECT rowid FROM probes ORDER BY atime LIMIT ?)",
+                             (count - self.max_entries,))
+
+    def _before_close(self):
+        self._flush_touched()
+        try:
+            self._evict()
+        except sqlite3.Error:
+            pass
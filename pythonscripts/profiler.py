@@ -0,0 +1,101 @@
+#! /usr/bin/env python3
+
+"""
+Simple per-stage wall time profiler. Records the duration of each stage for
+each file, reports throughput and latency percentiles and optionally writes
+every measurement into an NDJSON trace file.
+"""
+
+import sys
+import json
+import math
+import time
+import threading
+from array import array
+from contextlib import contextmanager, nullcontext
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted values.
+    """
+    index = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[index]
+
+
+class StageStats:
+    def __init__(self):
+        self.durations = array("d")
+        self.bytes = 0
+
+
+class Profiler:
+    def __init__(self, enabled=False, trace_path=None):
+        self.enabled = enabled or trace_path is not None
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._trace = open(trace_path, "w") if trace_path else None
+
+    def stage(self, name, path=None, size=0):
+        """ Context manager measuring one stage of processing of one file.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self._measure(name, path, size)
+
+    @contextmanager
+    def _measure(self, name, path, size):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start, path, size, start)
+
+    def record(self, name, seconds, path=None, size=0, start=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self.stages.setdefault(name, StageStats())
+            stats.durations.append(seconds)
+            stats.bytes += size
+            if self._trace is not None:
+                if start is None:
+                    start = time.monotonic() - seconds
+                record = {"stage": name, "path": path, "start": round(start - self._start, 6),
+                          "seconds": round(seconds, 6), "bytes": size}
+                self._trace.write(json.dumps(record) + "\n")
+
+    def histogram(self, durations, file):
+        """ Print histogram of durations with power-of-two buckets (in milliseconds).
+        """
+        buckets = {}
+        for d in durations:
+            bucket = max(0, math.ceil(math.log2(max(d * 1000, 1e-3))))
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+        peak = max(buckets.values())
+        for bucket in range(min(buckets), max(buckets) + 1):
+            count = buckets.get(bucket, 0)
+            bar = "#" * math.ceil(40 * count / peak) if count else ""
+            print("        <= %8d ms % 8d %s" % (2 ** bucket, count, bar), file=file)
+
+    def report(self, file=sys.stdout):
+        if not self.enabled:
+            return
+        elapsed = time.monotonic() - self._start
+        print(file=file)
+        print("-----------profile (wall time %.1f s)-----------" % elapsed, file=file)
+        for name, stats in self.stages.items():
+            durations = sorted(stats.durations)
+            total = sum(durations)
+            print("%-8s files: %d, busy: %.1f s, %.1f files/s, %.2f MB/s" %
+                  (name, len(durations), total, len(durations) / elapsed, stats.bytes / elapsed / 1e6), file=file)
+            print("         latency p50: %.1f ms, p95: %.1f ms, p99: %.1f ms, max: %.1f ms" %
+                  tuple(1000 * x for x in (percentile(durations, 50), percentile(durations, 95),
+                                            percentile(durations, 99), durations[-1])), file=file)
+            self.histogram(durations, file)
+        print("------------------------------------------------", file=file)
+
+    def close(self):
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
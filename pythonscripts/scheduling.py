@@ -0,0 +1,26 @@
+#! /usr/bin/env python3
+
+"""
+Longest-processing-time-first (LPT) ordering of a stream of jobs.
+
+Dispatching the biggest jobs first avoids stragglers: a long job that happens
+to come last keeps one worker busy long after the others have finished. To
+keep the processing streaming, the jobs are reordered only within a bounded
+look-ahead window instead of sorting the whole stream.
+"""
+
+import heapq
+
+
+def lpt_order(iterable, cost, window):
+    """ Yield items of 'iterable' so that the item with the highest cost(item)
+        among the next 'window' items is always yielded first.
+    """
+    heap = []
+    for index, item in enumerate(iterable):
+        # the index breaks ties, so the items themselves are never compared
+        heapq.heappush(heap, (-cost(item), index, item))
+        if len(heap) >= window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
@@ -0,0 +1,79 @@
+#! /usr/bin/env python3
+
+"""
+Common setup of the SQLite databases used as persistent caches.
+
+The connection runs in the autocommit mode (no implicit transaction is left
+open between the calls) in the WAL journal mode with a busy timeout, so the
+database can be shared by concurrent processes. When the schema version stored
+in the database differs from the expected one, all tables are dropped and
+created again. The connection is shared by all threads of the process, access
+is serialized by a lock.
+"""
+
+import os
+import sqlite3
+import threading
+
+# seconds to wait for a lock held by another process
+BUSY_TIMEOUT = 5.0
+
+
+def cache_path(name):
+    cache_dir = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache_dir, "pythonscripts", name)
+
+
+class SQLiteDatabase:
+    # bump when the layout of the stored data changes
+    SCHEMA_VERSION = 1
+    # statements creating the tables and indexes, they must use "IF NOT EXISTS"
+    SCHEMA = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # the schema is checked and created in one transaction, so that concurrent
+        # processes opening the database do not drop each other's tables
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.SCHEMA_VERSION:
+                tables = self._db.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                                          "AND name NOT LIKE 'sqlite_%'").fetchall()
+                for name, in tables:
+                    self._db.execute('DROP TABLE IF EXISTS "%s"' % name)
+                self._db.execute("PRAGMA user_version=%d" % self.SCHEMA_VERSION)
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+
+    def _executemany(self, sql, rows):
+        """ Execute 'sql' for all 'rows' in one transaction. Must be called with
+            self._lock held. Returns False if the database failed, e.g. when it
+            stayed locked by another process for too long.
+        """
+        try:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany(sql, rows)
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _before_close(self):
+        """ Called with self._lock held before the connection is closed.
+        """
+        pass
+
+    def close(self):
+        with self._lock:
+            if self._db is None:
+                return
+            self._before_close()
+            self._db.close()
+            self._db = None
@@ -0,0 +1,88 @@
+#! /usr/bin/env python3
+
+"""
+Persistent index of the ReplayGain tag state of audio files, stored in an
+SQLite database.
+
+Entries are keyed by the path of the file and validated by its size and mtime,
+so the tag state of an unchanged file is known from a stat call alone and the
+file has to be opened only when it was modified since it was indexed.
+
+Updates are buffered and committed once per album (or after COMMIT_INTERVAL),
+so no write transaction is held open while the albums are processed and at
+most the updates of the current album are lost when the process is killed.
+"""
+
+import sqlite3
+import time
+
+from pythonscripts.sqlitedb import SQLiteDatabase, cache_path
+
+# seconds after which the buffered updates are committed even if no album has finished
+COMMIT_INTERVAL = 10.0
+
+
+def default_index_path():
+    return cache_path("replaygain.sqlite")
+
+
+class TagIndex(SQLiteDatabase):
+    SCHEMA_VERSION = 1
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS tags (
+            path TEXT PRIMARY KEY NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            complete INTEGER NOT NULL
+        )""",
+    )
+
+    def __init__(self, path=None):
+        super().__init__(path or default_index_path())
+        self.hits = 0
+        self.misses = 0
+        # rows not committed yet
+        self._pending = []
+        self._last_commit = time.monotonic()
+
+    def get(self, path, st):
+        """ Return True if the file has all ReplayGain tags, False if it does not,
+            or None if the file is not indexed or was modified since it was indexed.
+            'st' is the os.stat_result of the file. Errors of the database are
+            treated as misses.
+        """
+        with self._lock:
+            try:
+                row = self._db.execute("SELECT size, mtime_ns, complete FROM tags WHERE path=?", (path,)).fetchone()
+            except sqlite3.Error:
+                row = None
+            if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return bool(row[2])
+
+    def put(self, path, st, complete):
+        """ Buffer an update of the index. The updates are committed by commit(),
+            which should be called when an album is finished, or automatically
+            when COMMIT_INTERVAL has passed since the last commit.
+        """
+        with self._lock:
+            self._pending.append((path, st.st_size, st.st_mtime_ns, int(complete)))
+            if time.monotonic() - self._last_commit >= COMMIT_INTERVAL:
+                self._commit()
+
+    def commit(self):
+        with self._lock:
+            if self._db is not None:
+                self._commit()
+
+    def _commit(self):
+        pending, self._pending = self._pending, []
+        self._last_commit = time.monotonic()
+        if pending:
+            # on failure the files are simply checked again next time
+            self._executemany("INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)", pending)
+
+    def _before_close(self):
+        self._commit()
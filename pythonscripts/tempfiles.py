@@ -2,29 +2,78 @@
 
 """
 Create temporary file, close file descriptor and return full path of the file.
+
+Temporary files can be created next to their final destination and moved into
+place with an atomic rename by commit(). All files which were not committed are
+removed at exit or when the process is terminated by SIGTERM or SIGHUP. The
+registry is shared by all threads.
 """
 
 import os
 import tempfile
 import atexit
+import signal
+import threading
 
 class TempFiles:
-    def __init__(self):
-        self.tempFiles = []
+    def __init__(self, handle_signals=True):
+        self.tempFiles = set()
+        self.lock = threading.Lock()
+        # mkstemp creates files with mode 0600, committed files should get the default mode
+        umask = os.umask(0)
+        os.umask(umask)
+        self.fileMode = 0o666 & ~umask
         atexit.register(self.removeAll)
+        if handle_signals and threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGHUP):
+                signal.signal(signum, self._signalHandler)
+
+    def _signalHandler(self, signum, frame):
+        self.removeAll()
+        # terminate with the default action of the signal
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
 
     def removeAll(self):
-        for file in self.tempFiles[:]:
+        with self.lock:
+            files = list(self.tempFiles)
+        for file in files:
             self.remove(file)
 
     def remove(self, file):
-        if file in self.tempFiles and os.path.exists(file):
+        with self.lock:
+            if file not in self.tempFiles:
+                return
+            self.tempFiles.discard(file)
+        try:
             os.remove(file)
-            self.tempFiles.remove(file)
+        except FileNotFoundError:
+            pass
 
     def getTempFileName(self, prefix="tmp", suffix="", dir=None, text=False):
         fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=dir, text=text)
         os.close(fd)
-        self.tempFiles.append(path)
+        with self.lock:
+            self.tempFiles.add(path)
+        return path
+
+    def getTempFileNameFor(self, destination):
+        """ Create hidden temporary file in the directory of 'destination',
+            so that it can be committed by a rename on the same filesystem.
+        """
+        dirname, basename = os.path.split(os.path.abspath(destination))
+        fd, path = tempfile.mkstemp(prefix="." + basename + ".", suffix=".tmp", dir=dirname)
+        try:
+            os.fchmod(fd, self.fileMode)
+        finally:
+            os.close(fd)
+        with self.lock:
+            self.tempFiles.add(path)
         return path
 
+    def commit(self, file, destination):
+        """ Atomically replace 'destination' with the temporary file 'file'.
+        """
+        os.replace(file, destination)
+        with self.lock:
+            self.tempFiles.discard(file)
@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+
+"""
+Parallel directory tree walker.
+
+The tree is walked iteratively (no recursion limit) with os.scandir, whose
+DirEntry objects carry the file type, so no extra stat is needed per entry.
+Directory reads are fanned out over a thread pool, which helps on network
+filesystems where walking is latency-bound. Entries are yielded as soon as
+their directory has been read; the order is not deterministic.
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def _dir_key(entry):
+    try:
+        st = entry.stat()
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+def _scan(path, extensions, follow_symlinks):
+    files = []
+    dirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=follow_symlinks):
+                dirs.append((entry.path, _dir_key(entry) if follow_symlinks else None))
+            elif entry.is_file(follow_symlinks=follow_symlinks):
+                if extensions is None or entry.name.endswith(extensions):
+                    files.append(entry)
+    return path, files, dirs
+
+
+def scandir_walk(roots, recursive=True, extensions=None, group_by_dir=False, include_empty=False,
+                 follow_symlinks=False, workers=8):
+    """ Walk directories in 'roots' and yield os.DirEntry objects of the files found.
+
+        'extensions' is a tuple of filename suffixes to select (e.g. (".mp3", ".flac")).
+        With group_by_dir=True, tuples (dirpath, [DirEntry, ...]) are yielded instead,
+        one per directory; directories without selected files are skipped unless
+        include_empty=True. A directory is always yielded before its subdirectories.
+
+        Symbolic links to directories are not followed unless follow_symlinks=True,
+        like in os.walk. When they are followed, each directory (identified by its
+        device and inode numbers) is walked only once, so symlink loops are skipped.
+    """
+    if isinstance(extensions, str):
+        extensions = (extensions,)
+    elif extensions is not None:
+        extensions = tuple(extensions)
+
+    pending = deque(roots)
+    running = set()
+    # (st_dev, st_ino) of the directories queued so far, used only when following symlinks
+    visited = set()
+    if follow_symlinks:
+        for root in roots:
+            try:
+                st = os.stat(root)
+                visited.add((st.st_dev, st.st_ino))
+            except OSError:
+                pass
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            # keep the number of outstanding directory reads bounded
+            while pending and len(running) < 2 * workers:
+                running.add(executor.submit(_scan, pending.popleft(), extensions, follow_symlinks))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, files, dirs = future.result()
+                if recursive:
+                    for dirpath, key in dirs:
+                        if key is not None:
+                            if key in visited:
+                                continue
+                            visited.add(key)
+                        pending.append(dirpath)
+                if group_by_dir:
+                    if files or include_empty:
+                        yield path, files
+                else:
+                    yield from files
@@ -0,0 +1,118 @@
+#! /usr/bin/env python3
+
+"""
+Benchmark of the native loudness engine against mp3gain.
+
+Every album (directory of mp3 files) is analysed by mp3gain (without touching
+the tags) and by the native EBU R128 engine. The wall time of both engines and
+the differences of the computed track and album values are appended to a JSON
+results file. Note that mp3gain implements ReplayGain 1, so a small systematic
+offset of the gains is expected; the spread around the mean offset shows how
+well the engines agree.
+"""
+
+import os
+import argparse
+import platform
+import subprocess
+import time
+import datetime
+
+from pythonscripts.benchresults import save_results
+from pythonscripts.cpu import usable_cpus
+from pythonscripts.walk import scandir_walk
+from pythonscripts.loudness import analyze_file, LoudnessResult
+from replaygain import parse_mp3gain_output
+
+
+def albums(paths, recursive):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, entries in scandir_walk([path], recursive=recursive, extensions=".mp3", group_by_dir=True, follow_symlinks=True):
+                yield sorted(entry.path for entry in entries)
+        else:
+            yield [path]
+
+
+def run_mp3gain(files):
+    # "-s s" skips reading and writing of the stored analysis
+    output = subprocess.check_output(["mp3gain", "-q", "-o", "-s", "s"] + files, universal_newlines=True)
+    return parse_mp3gain_output(output.splitlines())
+
+
+def run_native(files, true_peak):
+    results = [analyze_file(path, true_peak=true_peak) for path in files]
+    album = LoudnessResult.merge(results)
+    tracks = {path: (result.gain, result.peak) for path, result in zip(files, results)}
+    return tracks, (album.gain, album.peak)
+
+
+def stats(values):
+    if not values:
+        return None
+    mean = sum(values) / len(values)
+    return {
+        "mean": mean,
+        "max_abs": max(abs(x) for x in values),
+        # spread around the mean offset
+        "max_dev": max(abs(x - mean) for x in values),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare the speed and results of the native loudness engine and mp3gain")
+    parser.add_argument("-r", "--recursive", action="store_true", help="browse directories recursively")
+    parser.add_argument("--true-peak", action="store_true", help="compute the true peak with the native engine")
+    parser.add_argument("-o", "--results", action="store", default="replaygain-bench.json", help="JSON file to which the results are appended, default=%(default)s")
+    parser.add_argument("path", nargs="+", help="mp3 file(s) or directory(ies) with albums")
+    args = parser.parse_args()
+
+    seconds = {"mp3gain": 0.0, "native": 0.0}
+    track_gain, track_peak, album_gain = [], [], []
+    count_tracks = 0
+    count_albums = 0
+    for files in albums(args.path, args.recursive):
+        start = time.monotonic()
+        reference = run_mp3gain(files)
+        seconds["mp3gain"] += time.monotonic() - start
+        start = time.monotonic()
+        native = run_native(files, args.true_peak)
+        seconds["native"] += time.monotonic() - start
+        if reference is None:
+            print("unable to parse mp3gain output for album: {}".format(os.path.dirname(files[0])))
+            continue
+        count_albums += 1
+        for path, (gain, peak) in native[0].items():
+            if path in reference[0]:
+                count_tracks += 1
+                track_gain.append(gain - reference[0][path][0])
+                track_peak.append(peak - reference[0][path][1])
+        album_gain.append(native[1][0] - reference[1][0])
+
+    result = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "cpus": usable_cpus(),
+        "albums": count_albums,
+        "tracks": count_tracks,
+        "true_peak": args.true_peak,
+        "seconds": seconds,
+        "difference": {
+            "track_gain_db": stats(track_gain),
+            "track_peak": stats(track_peak),
+            "album_gain_db": stats(album_gain),
+        },
+    }
+
+    print("{} albums, {} tracks".format(count_albums, count_tracks))
+    for engine, value in seconds.items():
+        print("  %-8s %8.2f s" % (engine, value))
+    if seconds["native"] > 0:
+        print("  speedup  %8.2fx" % (seconds["mp3gain"] / seconds["native"]))
+    for name, value in result["difference"].items():
+        if value is not None:
+            print("  %-14s mean %+.3f, max |diff| %.3f, max deviation from mean %.3f" %
+                  (name, value["mean"], value["max_abs"], value["max_dev"]))
+    save_results(args.results, result)
+    print("Results appended to {}".format(args.results))
@@ -5,50 +5,162 @@ import os
 import argparse
 import subprocess
 import asyncio
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
 import taglib
 
-from pythonscripts.cpu import cores_count
+from pythonscripts.cpu import usable_cpus, split_budget
 from pythonscripts.logger import Logger
+from pythonscripts.pressure import AdaptiveLimit
+from pythonscripts.walk import scandir_walk
+from pythonscripts.scheduling import lpt_order
+from pythonscripts.loudness import analyze_file, LoudnessResult, AnalysisCache
+from pythonscripts.tagindex import TagIndex, default_index_path
+from pythonscripts.inotify import TreeWatcher
+
+# files supported by the native engine, mp3gain handles only mp3
+AUDIO_EXTENSIONS = (".mp3", ".flac", ".ogg", ".opus")
+
+REPLAYGAIN_TAGS = set(["replaygain_track_gain", "replaygain_album_gain", "replaygain_track_peak", "replaygain_album_peak"])
+
+
+def same_tag_value(existing, value):
+    """ Returns True if the existing tag value (list of strings or None) equals
+        the formatted 'value' at the precision of 'value', e.g. "3.1 dB" equals
+        "3.10 dB".
+    """
+    if not existing or len(existing) != 1:
+        return False
+    if existing[0] == value:
+        return True
+    number, _, unit = value.partition(" ")
+    old_number, _, old_unit = existing[0].strip().partition(" ")
+    if old_unit != unit:
+        return False
+    try:
+        old_number = float(old_number)
+    except ValueError:
+        return False
+    decimals = len(number.partition(".")[2])
+    return "%.*f" % (decimals, old_number) == number
+
+
+def parse_mp3gain_output(lines):
+    """ Parse the tab-separated output of 'mp3gain -o'. Returns tuple (tracks, album)
+        where 'tracks' is a dict mapping file names to (gain, peak) and 'album' is
+        the (gain, peak) tuple of the album, or None if the output is not valid.
+    """
+    album_parts = lines[-1].strip().split("\t")
+
+    # just in case
+    if album_parts[0] != '"Album"':
+        return None
+
+    a_gain = float(album_parts[2])              # album gain
+    a_peak = float(album_parts[3]) / 32768.0    # album peak
+
+    tracks = {}
+    # skip the header and the album summary
+    for line in lines[1:-1]:
+        parts = line.strip().split("\t")
+        fname = parts[0]                        # filename
+        t_gain = float(parts[2])                # track gain
+        t_peak = float(parts[3]) / 32768.0      # track peak
+        tracks[fname] = (t_gain, t_peak)
+    return tracks, (a_gain, a_peak)
+
 
 class ReplayGain:
     """ Will consider all files to belong to one album.
     """
 
-    def __init__(self, logger, options, files):
+    def __init__(self, logger, options, files, tag_index=None, write_executor=None, decode_threads=1):
         # logger
         self.log = logger
         self.log.filename = None
 
         # internals
         self.raw_lines = []
-        self.data_files = []
-        self.data_album = {}
+        # file name -> (gain, peak) and (gain, peak) of the album
+        self.data_files = {}
+        self.data_album = None
 
         # options
         self.force = options.force
         self.force_album = options.force_album
         self.force_track = options.force_track
+        self.engine = options.engine
+        self.true_peak = options.true_peak
+        self.sidecar_cache = options.sidecar_cache
         self.files = files
+        # optional TagIndex object
+        self.tag_index = tag_index
+        # AnalysisCache object, loaded by load_analysis_cache
+        self.analysis_cache = None
+        # optional executor for saving the files
+        self.write_executor = write_executor
+        # number of ffmpeg decoder threads of the native engine
+        self.decode_threads = decode_threads
+        self.count_written = 0
+        self.count_unchanged = 0
+        # file name -> mtime_ns after our tag write
+        self.written = {}
 
     def run(self):
-        # check if all files have ReplayGain tags; mp3gain runs very long
-        if not (self.force or self.force_album or self.force_track) and self.all_files_have_replaygain_tags():
-            self.log.error("All files already have ReplayGain tags, no action taken.")
-            return
-        if self.run_mp3gain():
-            self.update_tags()
+        try:
+            if not self.needs_update():
+                return
+            if self.engine == "native":
+                ok = self.run_native()
+            else:
+                ok = self.run_mp3gain() and self.parse_mp3gain()
+            if ok:
+                self.update_tags()
+            self.save_analysis_cache()
+        finally:
+            self.save_tag_index()
+
+    def needs_update(self):
+        # check if all files have ReplayGain tags; the analysis runs very long
+        if not (self.force or self.force_album or self.force_track):
+            try:
+                complete = self.all_files_have_replaygain_tags()
+            except OSError as e:
+                # e.g. a file was removed meanwhile
+                self.log.error("%s, no action taken." % e)
+                return False
+            if complete:
+                self.log.error("All files already have ReplayGain tags, no action taken.")
+                return False
+        return True
 
     def all_files_have_replaygain_tags(self):
         """ Quick analysis to determine if input files contain replaygain_* tags.
+            Files are opened only when they are not in the tag index or were
+            modified since they were indexed.
         """
         for fname in self.files:
-            # open id3 tag
-            f = taglib.File(fname)
-
+            st = os.stat(fname)
+            complete = None
+            if self.tag_index is not None:
+                complete = self.tag_index.get(fname, st)
+            if complete is None:
+                complete = self.has_replaygain_tags(fname)
+                if self.tag_index is not None:
+                    self.tag_index.put(fname, st, complete)
+            if not complete:
+                return False
+        return True
+
+    def has_replaygain_tags(self, fname):
+        # open id3 tag
+        f = taglib.File(fname)
+        try:
             tags = set([tag.lower() for tag in f.tags.keys() if tag.lower().startswith("replaygain_")])
-            return tags == set(["replaygain_track_gain", "replaygain_album_gain", "replaygain_track_peak", "replaygain_album_peak"])
+        finally:
+            f.close()
+        return REPLAYGAIN_TAGS <= tags
 
     def run_mp3gain(self):
         """ Compute values for replaygain_* tags.
@@ -74,31 +186,88 @@ class ReplayGain:
         finally:
             return ret
 
-    def update_tags(self):
-        """ Add computed replaygain_* tags into all files.
+    def parse_mp3gain(self):
+        """ Parse the output of mp3gain into self.data_files and self.data_album.
         """
         self.log.debug("parsing mp3gain output")
-        album_parts = self.raw_lines[-1].strip().split("\t")
-
-        # just in case
-        if album_parts[0] != '"Album"':
+        result = parse_mp3gain_output(self.raw_lines)
+        if result is None:
             self.log.error("unable to parse mp3gain output")
-            return
+            return False
+        self.data_files, self.data_album = result
+        return True
+
+    def analyze_track(self, fname):
+        """ Analyse the loudness of one track with the native EBU R128 engine.
+            Returns LoudnessResult or None on error. The tracks of the album
+            may be analysed concurrently.
+        """
+        try:
+            st = os.stat(fname)
+            if self.analysis_cache is not None:
+                result = self.analysis_cache.get(fname, st)
+                if result is not None:
+                    self.log.debug("%s: using cached analysis" % fname)
+                    return result
+            self.log.debug("%s: analysing loudness" % fname)
+            result = analyze_file(fname, true_peak=self.true_peak, threads=self.decode_threads)
+            if self.analysis_cache is not None:
+                self.analysis_cache.put(fname, st, result)
+            return result
+        except subprocess.CalledProcessError as exc:
+            stderr = exc.stderr.decode(errors="replace").strip() if exc.stderr else ""
+            self.log.error("%s: %s returned error status %d: %s" % (fname, os.path.basename(exc.cmd[0]), exc.returncode, stderr))
+        except (OSError, ValueError) as e:
+            self.log.error("%s: %s" % (fname, e))
+        return None
+
+    def set_track_results(self, results):
+        """ Compute values for replaygain_* tags from the dict mapping file names
+            to LoudnessResult objects. The album value is computed from the
+            loudness histograms of the tracks, not by analysing them again.
+        """
+        if None in results.values():
+            return False
+        for fname, result in results.items():
+            self.data_files[fname] = (result.gain, result.peak)
+        album = LoudnessResult.merge(results.values())
+        self.data_album = (album.gain, album.peak)
+        return True
+
+    def load_analysis_cache(self):
+        """ Load the sidecar cache of the track analysis results from the album directory.
+        """
+        if self.sidecar_cache and self.files:
+            self.analysis_cache = AnalysisCache(os.path.dirname(self.files[0]), self.true_peak)
 
-        a_gain = float(album_parts[2])              # album gain
-        a_peak = float(album_parts[3]) / 32768.0    # album peak
+    def save_analysis_cache(self):
+        if self.analysis_cache is None:
+            return
+        try:
+            self.analysis_cache.save(self.files)
+        except OSError as e:
+            self.log.error("%s: %s" % (self.analysis_cache.path, e))
 
-        del self.raw_lines[0]   # header
-        del self.raw_lines[-1]  # album summary
-        for line in self.raw_lines:
-            parts = line.strip().split("\t")
-            fname = parts[0]    # filename
+    def save_tag_index(self):
+        """ Commit the tag index updates of the album.
+        """
+        if self.tag_index is not None:
+            self.tag_index.commit()
 
-            self.log.filename = fname
-            self.log.debug("begin processing file")
+    def run_native(self):
+        """ Compute values for replaygain_* tags with the native EBU R128 engine.
+        """
+        self.load_analysis_cache()
+        return self.set_track_results({fname: self.analyze_track(fname) for fname in self.files})
 
-            t_gain = float(parts[2])                # track gain
-            t_peak = float(parts[3]) / 32768.0      # track peak
+    def update_tags(self):
+        """ Add computed replaygain_* tags into all files. Files which already have
+            the same values (at the written precision) are not saved again. The
+            files are saved on self.write_executor when it is given.
+        """
+        jobs = []
+        for fname, (t_gain, t_peak) in self.data_files.items():
+            a_gain, a_peak = self.data_album
 
             # set t_gain, t_peak, a_gain, a_peak depending on options
             if self.force_album:
@@ -108,21 +277,59 @@ class ReplayGain:
                 a_gain = t_gain
                 a_peak = t_peak
 
-            # open id3 tag
-            f = taglib.File(fname)
-
-            # update tag
-            f.tags["REPLAYGAIN_TRACK_GAIN"] = "%.2f dB" % t_gain
-            f.tags["REPLAYGAIN_ALBUM_GAIN"] = "%.2f dB" % a_gain
-            f.tags["REPLAYGAIN_TRACK_PEAK"] = "%.6f" % t_peak
-            f.tags["REPLAYGAIN_ALBUM_PEAK"] = "%.6f" % a_peak
+            values = {
+                "REPLAYGAIN_TRACK_GAIN": "%.2f dB" % t_gain,
+                "REPLAYGAIN_ALBUM_GAIN": "%.2f dB" % a_gain,
+                "REPLAYGAIN_TRACK_PEAK": "%.6f" % t_peak,
+                "REPLAYGAIN_ALBUM_PEAK": "%.6f" % a_peak,
+            }
+            jobs.append((fname, values))
+
+        def write(job):
+            try:
+                return self.write_tags(*job)
+            except OSError as e:
+                # e.g. the file was removed after it was analysed
+                self.log.error("%s: %s" % (job[0], e))
+                return False
+
+        if self.write_executor is None:
+            written = [write(job) for job in jobs]
+        else:
+            written = list(self.write_executor.map(write, jobs))
+        self.count_written = sum(written)
+        self.count_unchanged = len(written) - self.count_written
+
+    def write_tags(self, fname, values):
+        """ Write the tags in the 'values' dict into the file, unless they are
+            already there. Returns True if the file was saved.
+        """
+        self.log.debug("%s: begin processing file" % fname)
 
-            # save tag
-            self.log.debug("saving modified ID3 tag")
-            f.save()
+        # open id3 tag
+        f = taglib.File(fname)
+        try:
+            if all(same_tag_value(f.tags.get(key), value) for key, value in values.items()):
+                self.log.debug("%s: tags are up to date" % fname)
+                saved = False
+            else:
+                f.tags.update(values)
+                self.log.debug("%s: saving modified tags" % fname)
+                f.save()
+                saved = True
+        finally:
+            f.close()
+        st = os.stat(fname)
+        if self.tag_index is not None:
+            self.tag_index.put(fname, st, True)
+        if saved:
+            self.written[fname] = st.st_mtime_ns
+            if self.analysis_cache is not None:
+                # the audio data is the same, only the tags have changed
+                self.analysis_cache.refresh(fname, st)
 
-            self.log.debug("done processing file")
-            self.log.filename = None
+        self.log.debug("%s: done processing file" % fname)
+        return saved
 
 
 class Main:
@@ -134,6 +341,39 @@ class Main:
         self.options = options
         self.recursive = options.recursive
         self.paths = options.files
+        # the number of running jobs is limited by self.limit, which is adjusted
+        # between --min-jobs and --max-jobs in the adaptive mode
+        self.adaptive = options.adaptive
+        jobs = options.jobs or usable_cpus()
+        if self.adaptive:
+            self.max_jobs = options.max_jobs or 2 * usable_cpus()
+            self.limit = AdaptiveLimit(options.min_jobs, self.max_jobs, initial=jobs)
+        else:
+            self.max_jobs = jobs
+            self.limit = AdaptiveLimit(jobs, jobs)
+        # each concurrent ffmpeg decoder gets an equal share of the CPU budget
+        _, self.decode_threads = split_budget(workers=self.max_jobs)
+        self.schedule = options.schedule
+        self.lookahead = options.lookahead
+        self.engine = options.engine
+        self.extensions = AUDIO_EXTENSIONS if options.engine == "native" else ".mp3"
+        self.tag_index = TagIndex(options.tag_index_file) if options.tag_index else None
+        self.write_jobs = options.write_jobs
+        self.write_executor = None
+        self.count_written = 0
+        self.count_unchanged = 0
+        self.count_lock = threading.Lock()
+        # in the watch mode, files processed by us are remembered (path -> mtime_ns)
+        # so that their inotify events do not trigger another run; note that taglib
+        # opens files for writing, so even reading the tags causes IN_CLOSE_WRITE
+        self.watch = options.watch
+        self.settle = options.settle
+        self.max_pending = options.max_pending
+        self.own_writes = {}
+        # albums which are queued or being processed in the watch mode
+        # (directory -> set of files whose events were held back meanwhile)
+        self.in_flight = {}
+        self.watcher = None
         del options.recursive   # don't want to pass it to ReplayGain object
         del options.files   # don't want to pass it to ReplayGain object
 
@@ -141,19 +381,183 @@ class Main:
         # We could use the default single-threaded executor with basically the same performance
         # (because of Python's GIL), but the ThreadPoolExecutor allows to limit the maximum number
         # of workers and thus the maximum number of concurrent subprocesses.
-        with ThreadPoolExecutor(max_workers=cores_count()) as executor:
-            loop = asyncio.get_event_loop()
-            tasks = [
-                loop.run_in_executor(executor, self.worker, path)
-                for path in self.queue_generator()
-            ]
-            for result in await asyncio.gather(*tasks):
+        #
+        # Albums are passed from the directory walk (running in a separate thread) to the
+        # workers through a bounded queue, so the processing starts while the walk is running.
+        queue = asyncio.Queue(maxsize=2 * self.max_jobs)
+        # tags are saved on a separate pool, which bounds the number of concurrent writes
+        with ThreadPoolExecutor(max_workers=self.max_jobs) as executor, \
+             ThreadPoolExecutor(max_workers=1) as walk_executor, \
+             ThreadPoolExecutor(max_workers=self.write_jobs) as self.write_executor:
+            loop = asyncio.get_running_loop()
+
+            async def producer():
+                if self.watch:
+                    await self.watch_producer(queue, walk_executor)
+                    return
+                albums = self.queue_generator()
+                if self.schedule == "lpt":
+                    albums = lpt_order(albums, self.album_cost, self.lookahead)
+                while True:
+                    paths = await loop.run_in_executor(walk_executor, next, albums, None)
+                    if paths is None:
+                        break
+                    await queue.put(paths)
+                for _ in range(self.max_jobs):
+                    await queue.put(None)
+
+            async def consumer():
+                while True:
+                    paths = await queue.get()
+                    if paths is None:
+                        break
+                    try:
+                        if self.engine == "native":
+                            # the tracks are analysed as separate jobs, see album_worker
+                            await self.album_worker(paths, executor)
+                            continue
+                        async with self.limit:
+                            await loop.run_in_executor(executor, self.worker, paths)
+                            self.limit.job_done(len(paths))
+                    finally:
+                        if self.watch:
+                            self.album_done(paths)
+
+            controller = asyncio.create_task(self.limit.control()) if self.adaptive else None
+            try:
+                await asyncio.gather(producer(), *[consumer() for _ in range(self.max_jobs)])
+            finally:
+                if controller is not None:
+                    controller.cancel()
+                if self.tag_index is not None:
+                    self.tag_index.close()
+                    self.logger.info("Tag index hits/misses: %d/%d" % (self.tag_index.hits, self.tag_index.misses))
+        print("Files rewritten: %d, already up to date: %d" % (self.count_written, self.count_unchanged))
+
+    def add_counts(self, rg):
+        with self.count_lock:
+            self.count_written += rg.count_written
+            self.count_unchanged += rg.count_unchanged
+
+    def file_mtimes(self, paths):
+        """ Return the mtimes of the album files before the album is processed.
+        """
+        mtimes = {}
+        if self.watch:
+            for path in paths:
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    pass
+        return mtimes
+
+    def remember_files(self, rg, before):
+        """ Remember the mtimes of the album files after the album was processed.
+            A file whose mtime is neither the one from 'before' nor the one after
+            our tag write was modified by someone else during the pass; it is not
+            remembered, so its event triggers another pass.
+        """
+        if not self.watch:
+            return
+        for path in rg.files:
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            if mtime_ns in (before.get(path), rg.written.get(path)):
+                with self.count_lock:
+                    self.own_writes[path] = mtime_ns
+
+    def is_own_write(self, path):
+        with self.count_lock:
+            mtime_ns = self.own_writes.pop(path, None)
+        if mtime_ns is None:
+            return False
+        try:
+            return os.stat(path).st_mtime_ns == mtime_ns
+        except OSError:
+            return True
+
+    async def watch_producer(self, queue, walk_executor):
+        """ Put albums which changed under the watched roots into the queue. The
+            producer runs until it is cancelled (e.g. by Ctrl+C).
+        """
+        loop = asyncio.get_running_loop()
+        watcher = self.watcher = TreeWatcher(self.paths, recursive=self.recursive, settle=self.settle,
+                                             max_pending=self.max_pending, extensions=self.extensions,
+                                             log=self.logger.error)
+        watcher.start()
+        self.logger.info("Watching %d directories" % sum(len(inotify.watches) for inotify in watcher.instances))
+        try:
+            async for dirpath, subtree, files in watcher.changes():
+                # the directory may be removed or renamed before it is scanned,
+                # then the entry is dropped (a renamed directory is reported again)
+                if subtree:
+                    self.logger.info("Rescanning %s" % dirpath)
+                    albums = self.walk_albums(dirpath, recursive=self.recursive)
+                    while True:
+                        try:
+                            paths = await loop.run_in_executor(walk_executor, next, albums, None)
+                        except OSError as e:
+                            self.logger.error("Cannot rescan %s: %s" % (dirpath, e))
+                            break
+                        if paths is None:
+                            break
+                        # which files changed is not known, all are checked after a pass
+                        await self.queue_album(queue, paths, paths)
+                    continue
+                if dirpath in self.in_flight:
+                    self.in_flight[dirpath].update(files)
+                    continue
+                # skip albums whose only changes are our own tag writes
+                if all([self.is_own_write(path) for path in files]):
+                    continue
+                try:
+                    paths = next(self.walk_albums(dirpath, recursive=False), None)
+                except OSError as e:
+                    self.logger.error("Cannot scan %s: %s" % (dirpath, e))
+                    continue
+                if paths:
+                    await self.queue_album(queue, paths, files)
+        finally:
+            watcher.close()
+
+    async def queue_album(self, queue, paths, files):
+        """ Put the album into the queue, unless it is already queued or being
+            processed. Then the events of 'files' are held back until the current
+            pass finishes, so two passes never process the same album concurrently.
+        """
+        album = os.path.dirname(paths[0])
+        if album in self.in_flight:
+            self.in_flight[album].update(files)
+            return
+        self.in_flight[album] = set()
+        await queue.put(paths)
+
+    def album_done(self, paths):
+        """ Report the events held back while the album was processed again. The
+            album is checked once more after they settle, unless the files were
+            not modified since they were remembered by remember_files.
+        """
+        held = self.in_flight.pop(os.path.dirname(paths[0]), None)
+        if held and self.watcher is not None:
+            self.watcher.mark(os.path.dirname(paths[0]), held)
+
+    def album_cost(self, paths):
+        """ Estimated cost of processing the album, which is its total size.
+        """
+        cost = 0
+        for path in paths:
+            try:
+                cost += os.path.getsize(path)
+            except OSError:
                 pass
+        return cost
 
     def worker(self, paths):
         paths = sorted(list(paths))
 
-        # skip dirs not containing any mp3 file
+        # skip dirs not containing any audio file
         if len(paths) == 0:
             return
 
@@ -162,60 +566,89 @@ class Main:
         for path in paths:
             print("  " + path)
 
+        # create ReplayGain object, pass files and run
+        rg = ReplayGain(self.logger, self.options, paths, self.tag_index, self.write_executor, self.decode_threads)
+        before = self.file_mtimes(paths)
         try:
-            # create ReplayGain object, pass files and run
-            rg = ReplayGain(self.logger, self.options, paths)
             rg.run()
+            self.add_counts(rg)
         except Exception as e:
             print(e, file=sys.stderr)
             raise
+        finally:
+            self.remember_files(rg, before)
 
-    def queue_generator(self):
-        """ For each directory in self.files returns generator returning full paths to mp3 files in that folder.
-            If self.files contains file paths instead of directory, it's returned as [file].
+    async def album_worker(self, paths, executor):
+        """ Process one album with the native engine. Each track is analysed as its
+            own job limited by self.limit, so the tracks of a big album are spread
+            over all workers. The tags are written once all tracks have finished.
         """
+        paths = sorted(list(paths))
+        if len(paths) == 0:
+            return
+
+        print("Procesing:")
+        for path in paths:
+            print("  " + path)
 
-        def walk(root):
-            dirs = []
-            files = []
-            for entry in os.scandir(root):
-                if entry.is_dir():
-                    dirs.append(entry.name)
-                elif entry.is_file() and entry.name.endswith(".mp3"):
-                    files.append(entry.name)
+        loop = asyncio.get_running_loop()
+        rg = ReplayGain(self.logger, self.options, paths, self.tag_index, self.write_executor, self.decode_threads)
 
-            # first yield found files, then recurse into subdirs
-            if files:
-                yield (os.path.join(root, x) for x in files)
-            if self.recursive:
-                for d in dirs:  # recurse into subdir
-                    for x in walk(os.path.join(root, d)):
-                        yield x
+        async def track(path):
+            async with self.limit:
+                result = await loop.run_in_executor(executor, rg.analyze_track, path)
+                self.limit.job_done(1)
+            return result
 
+        before = await loop.run_in_executor(executor, self.file_mtimes, paths)
+        try:
+            if not await loop.run_in_executor(executor, rg.needs_update):
+                return
+            await loop.run_in_executor(executor, rg.load_analysis_cache)
+            results = await asyncio.gather(*[track(path) for path in paths])
+            if rg.set_track_results(dict(zip(paths, results))):
+                await loop.run_in_executor(executor, rg.update_tags)
+                self.add_counts(rg)
+            await loop.run_in_executor(executor, rg.save_analysis_cache)
+        finally:
+            rg.save_tag_index()
+            self.remember_files(rg, before)
+
+    def queue_generator(self):
+        """ For each directory in self.files returns list of full paths to audio files in that folder.
+            If self.files contains file paths instead of directory, it's returned as [file].
+        """
         for path in self.paths:
             if os.path.isdir(path):
-                for x in walk(path):
-                    yield x
+                yield from self.walk_albums(path, self.recursive)
             else:
                 yield [path]
 
+    def walk_albums(self, path, recursive):
+        for dirpath, entries in scandir_walk([path], recursive=recursive, extensions=self.extensions, group_by_dir=True, follow_symlinks=True):
+            yield [entry.path for entry in entries]
+
 def main(prog_name, options):
     logger = Logger(options.log_level, prog_name)
-    logger.debug("Selected mp3 files:")
+    logger.debug("Selected files:")
     logger.debug("\n".join(sorted(options.files)))
     main = Main(logger, options)
-    asyncio.run(main.run())
+    try:
+        asyncio.run(main.run())
+    except KeyboardInterrupt:
+        if not options.watch:
+            raise
 
 def argparse_path_handler(path):
     if not os.path.exists(path):
         raise argparse.ArgumentTypeError("invalid path: '%s'" % path)
-    if os.path.isfile(path) and not path.endswith(".mp3"):
-        raise argparse.ArgumentTypeError("not a mp3 file: '%s'" % path)
+    if os.path.isfile(path) and not path.endswith(AUDIO_EXTENSIONS):
+        raise argparse.ArgumentTypeError("not a supported audio file: '%s'" % path)
     return os.path.abspath(path)
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Write correct ReplayGain tags into mp3 files; uses mp3gain internally")
+    parser = argparse.ArgumentParser(description="Write correct ReplayGain tags into audio files; uses mp3gain (mp3 only) or the native EBU R128 engine")
 
     # log level options
     log = parser.add_mutually_exclusive_group()
@@ -229,7 +662,30 @@ if __name__ == "__main__":
     group.add_argument("--force-album", action="store_true", help="write replaygain_album_{gain,peak} values into replaygain_track_{gain,peak} tags")
     group.add_argument("--force-track", action="store_true", help="write replaygain_track_{gain,peak} values into replaygain_album_{gain,peak} tags")
 
-    parser.add_argument("files", nargs="+", metavar="FILE | FOLDER", type=argparse_path_handler, help="path to mp3 file(s) or directory(ies)")
+    parser.add_argument("--engine", choices=("mp3gain", "native"), default="mp3gain", help="loudness analysis engine: mp3gain (ReplayGain 1, mp3 only, default) or native (ReplayGain 2.0 via ffmpeg, also flac, ogg and opus)")
+    parser.add_argument("--true-peak", action="store_true", help="compute the true peak (4x oversampled) instead of the sample peak with the native engine")
+    parser.add_argument("--tag-index", action="store_true", help="remember which files have ReplayGain tags in an SQLite database, so unchanged files are not opened again")
+    parser.add_argument("--tag-index-file", action="store", default=default_index_path(), metavar="PATH", help="path of the --tag-index database, default=%(default)s")
+    parser.add_argument("--sidecar-cache", action="store_true", help="keep the analysis results of the native engine in %s in each album directory, so only new or modified tracks are analysed again" % AnalysisCache.FILE_NAME)
+    parser.add_argument("--write-jobs", action="store", type=int, metavar="N", default=4, help="number of files whose tags are saved concurrently, default=4")
+    parser.add_argument("-j", "--jobs", action="store", type=int, metavar="N", help="number of concurrent jobs (mp3gain processes, or tracks analysed by the native engine), default is the number of usable CPUs")
+    parser.add_argument("--adaptive", action="store_true", help="adjust the number of concurrent jobs based on system pressure (PSI) and throughput, starting at --jobs")
+    parser.add_argument("--min-jobs", action="store", type=int, metavar="N", default=1, help="minimum number of concurrent jobs in the adaptive mode, default=1")
+    parser.add_argument("--max-jobs", action="store", type=int, metavar="N", help="maximum number of concurrent jobs in the adaptive mode, default is twice the number of CPUs")
+    parser.add_argument("--schedule", choices=("fifo", "lpt"), default="fifo", help="order of processing: fifo (walk order, default) or lpt (biggest albums first within the look-ahead window)")
+    parser.add_argument("--lookahead", action="store", type=int, metavar="N", default=64, help="number of albums considered for reordering by --schedule=lpt, default=64")
+    parser.add_argument("--watch", action="store_true", help="instead of processing the given directories, watch them with inotify and process albums in which files were written")
+    parser.add_argument("--settle", action="store", type=float, metavar="SECONDS", default=10, help="in the watch mode, process an album when no file was written in it for this time, default=10")
+    parser.add_argument("--max-pending", action="store", type=int, metavar="N", default=4096, help="in the watch mode, maximum number of directories waiting to settle; when exceeded, directories are coalesced into their common parent which is rescanned, default=4096")
+    parser.add_argument("files", nargs="+", metavar="FILE | FOLDER", type=argparse_path_handler, help="path to audio file(s) or directory(ies)")
 
     args = parser.parse_args()
+    if args.engine == "mp3gain":
+        for path in args.files:
+            if os.path.isfile(path) and not path.endswith(".mp3"):
+                parser.error("not a mp3 file: '%s' (use --engine=native for other formats)" % path)
+    if args.watch:
+        for path in args.files:
+            if not os.path.isdir(path):
+                parser.error("only directories can be watched: '%s'" % path)
     main(sys.argv[0], args)
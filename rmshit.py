@@ -6,6 +6,8 @@ from pathlib import Path
 
 import yaml
 
+from pythonscripts.walk import scandir_walk
+
 DEFAULT_CONFIG = """
 - ~/.adobe              # Flash crap
 - ~/.macromedia         # Flash crap
@@ -63,7 +65,7 @@ DEFAULT_CONFIG = """
 
 def get_size(path):
     if Path(path).is_dir():
-        return sum(p.stat().st_size for p in Path(path).rglob("*"))
+        return sum(entry.stat(follow_symlinks=False).st_size for entry in scandir_walk([path], follow_symlinks=False))
     return Path(path).stat().st_size
 
 
@@ -7,6 +7,8 @@
 import sys
 import os
 
+from pythonscripts.walk import scandir_walk
+
 
 class Main:
     def __init__(self, oldRoot, newRoot):
@@ -14,14 +16,12 @@ class Main:
         self.newRoot = newRoot
 
     def browse(self, path):
-        for file in os.listdir(path):
-            absPath = os.path.join(path, file)
-            relPath = os.path.relpath(absPath, self.oldRoot)
-            if os.path.isdir(absPath):
-                os.mkdir(os.path.join(self.newRoot, relPath))
-                self.browse(absPath)
-            elif os.path.isfile(absPath):
-                open(os.path.join(self.newRoot, relPath), "w").close()
+        # directories are yielded before their subdirectories
+        for dirPath, entries in scandir_walk([path], group_by_dir=True, include_empty=True, follow_symlinks=True):
+            newDir = os.path.join(self.newRoot, os.path.relpath(dirPath, self.oldRoot))
+            os.makedirs(newDir, exist_ok=True)
+            for entry in entries:
+                open(os.path.join(newDir, entry.name), "w").close()
 
     def touchTree(self):
         os.mkdir(newRoot)